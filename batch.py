@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+
+"""
+Crawl several projects in one process.
+
+Projects are crawled concurrently and share a request scheduler, which limits the number of
+requests in progress across all projects, spaces requests to each host (even when several
+projects use the same host) and gives free slots to waiting requests in the order in which they started waiting.
+Options after -- are passed to main.py for every project.
+"""
+
+import os
+from os.path import join as pjoin
+import sys
+import json
+import time
+import queue
+import logging
+import threading
+
+import main as crawler
+import metrics
+from fetch import RequestScheduler
+
+logger = logging.getLogger('batch')
+
+
+class ThreadNameFilter(logging.Filter):
+    """Passes records logged by threads of a single project.
+
+    Threads started for a project are named after the thread which starts them followed by /,
+    which can't be part of a project's name (the base name of its output directory).
+    """
+
+    def __init__(self, name):
+        super().__init__()
+        self.thread_name = name
+
+    def filter(self, record):
+        return record.threadName == self.thread_name or record.threadName.startswith(self.thread_name + '/')
+
+
+def get_project_names(out_dirs):
+    'Return a unique name (used for naming threads) for each project'
+    names = []
+    for out_dir in out_dirs:
+        name = os.path.basename(os.path.normpath(out_dir))
+        if name in names:
+            name = '{}.{}'.format(name, len(names))
+        names.append(name)
+    return names
+
+
+def configure_logging(out_dirs, names, verbosity):
+    'Log to the console and to info.log and error.log of each project'
+    formatter = logging.Formatter('%(asctime)s %(levelname)s %(threadName)s %(name)s: %(message)s')
+    root = logging.getLogger()
+    root.setLevel(logging.DEBUG if verbosity >= 3 else logging.INFO)
+    console = logging.StreamHandler(sys.stdout)
+    console.setFormatter(formatter)
+    root.addHandler(console)
+    for out_dir, name in zip(out_dirs, names):
+        for fname, level in (('info.log', logging.DEBUG), ('error.log', logging.WARNING)):
+            handler = logging.FileHandler(pjoin(out_dir, fname))
+            handler.setLevel(level)
+            handler.setFormatter(formatter)
+            handler.addFilter(ThreadNameFilter(name))
+            root.addHandler(handler)
+    if verbosity <= 1:
+        logging.getLogger('fetch').setLevel(logging.WARNING)
+
+
+def run_batch(projects, scheduler, parallel, stop_event):
+    """Crawl projects, which is a list of (name, args for main.crawl), using parallel threads.
+
+    Return a list of summaries in the order of projects.
+    """
+    todo = queue.Queue()
+    for i, project in enumerate(projects):
+        todo.put((i, project))
+    summaries = [None] * len(projects)
+
+    def work():
+        while not stop_event.is_set():
+            try:
+                i, (name, args) = todo.get_nowait()
+            except queue.Empty:
+                return
+            # Log records of the project are told apart by the names of the threads which log them.
+            threading.current_thread().name = name
+            logger.info('Crawling {}'.format(args.out_dir))
+            start_time = time.perf_counter()
+            try:
+                summary = crawler.crawl(args, scheduler, stop_event, save_project_metrics=False)
+            except Exception:
+                logger.exception('Caught exception while crawling {}'.format(args.out_dir))
+                summary = {'out_dir': args.out_dir, 'status': 1, 'pages': 0, 'fetches': 0}
+            summary['time'] = time.perf_counter() - start_time
+            summaries[i] = summary
+
+    threads = [threading.Thread(target=work, name='batch-{}'.format(i), daemon=True)
+        for i in range(min(parallel, len(projects)))]
+    for thread in threads:
+        thread.start()
+    try:
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(1)
+    except KeyboardInterrupt:
+        logger.info('Stopping; progress of every project is saved')
+        stop_event.set()
+        for thread in threads:
+            thread.join()
+    return summaries
+
+
+def main():
+    import argparse
+    argv = sys.argv[1:]
+    main_argv = []
+    if '--' in argv:
+        i = argv.index('--')
+        argv, main_argv = argv[:i], argv[i + 1:]
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('out_dirs', nargs='*', help='Output directories of projects')
+    parser.add_argument('--projects-file', help='file listing output directories of projects, one per line')
+    parser.add_argument('--parallel', type=int, default=4, help='number of projects to crawl at once')
+    parser.add_argument('--max-requests', type=int,
+        help='maximum number of requests in progress across all projects (default: --parallel)')
+    parser.add_argument('--delay', type=float, default=1,
+        help='time in seconds for which to wait between 2 http requests to the same host'
+            ' (can be overridden for a host in the hosts section of a config file)')
+    parser.add_argument('--global-delay', type=float, default=0,
+        help='time in seconds for which to wait between 2 http requests to any hosts')
+    parser.add_argument('--summary', help='path at which to save the summary of the batch as JSON')
+    parser.add_argument('--verbosity', type=int, default=2,
+        help='1: print error messages, 2: print fetch messages, 3: print sno')
+    args = parser.parse_args(argv)
+
+    out_dirs = list(args.out_dirs)
+    if args.projects_file is not None:
+        with open(args.projects_file) as fobj:
+            out_dirs.extend(line.strip() for line in fobj if line.strip() and not line.startswith('#'))
+    if not out_dirs:
+        parser.error('no projects given')
+    names = get_project_names(out_dirs)
+    configure_logging(out_dirs, names, args.verbosity)
+
+    projects = []
+    for out_dir, name in zip(out_dirs, names):
+        project_args = crawler.get_parser().parse_args([out_dir, '--verbosity', str(args.verbosity)] + main_argv)
+        projects.append((name, project_args))
+    parallel = max(args.parallel, 1)
+    scheduler = RequestScheduler(args.delay, max_requests=args.max_requests or parallel,
+        global_delay=args.global_delay)
+    summaries = run_batch(projects, scheduler, parallel, threading.Event())
+
+    failed = 0
+    for name, summary in zip(names, summaries):
+        if summary is None:
+            logger.info('{}: not crawled'.format(name))
+            continue
+        failed += summary['status'] != 0
+        logger.info('{}: {} with {} new pages and {} fetches in {:.1f} seconds'.format(name,
+            'failed' if summary['status'] else 'done', summary['pages'], summary['fetches'], summary['time']))
+    logger.info('{} projects, {} failed'.format(len(summaries), failed))
+    logger.info(metrics.get_metrics().summary())
+    if args.summary is not None:
+        with open(args.summary, 'w') as fobj:
+            json.dump({'projects': [s for s in summaries if s is not None],
+                'metrics': metrics.get_metrics().report()}, fobj, indent=4)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
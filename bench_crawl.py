@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark crawling a synthetic webcomic served from a local HTTP server.
+
+A comic of N pages (linked by prev and next, each with one image) is generated
+in memory and main.py is run against it for each requested archive size.
+Throughput and the time spent in each stage (as recorded in out_dir/metrics.json)
+are reported. Arguments which are not recognized here are passed on to main.py.
+"""
+
+import os
+from os.path import join as pjoin
+import sys
+import gzip
+import json
+import time
+import random
+import shutil
+import tempfile
+import threading
+import subprocess
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+STAGES = ('sleep', 'fetch', 'retry_sleep', 'parse', 'scrape', 'info_write', 'journal_sync',
+    'download', 'render', 'index')
+
+PAGE_TEMPLATE = '''<html><head><title>Comic {i}</title></head><body>
+<div id="ctitle">Comic {i}</div>
+<a rel="prev" href="{prev}">Prev</a> <a rel="next" href="{next}">Next</a>
+<div id="comic"><img src="/img/c{i}.png" title="Alt text of comic {i}"/></div>
+<ul>{filler}</ul>
+</body></html>'''
+
+
+class SyntheticComic:
+    'Pages and images of a webcomic with n pages'
+
+    def __init__(self, n, page_size=20000, image_size=50000, latency=0, error_rate=0, gzip=False, seed=0):
+        self.n = n
+        self.page_size = page_size
+        self.image = random.Random(seed).getrandbits(8 * image_size).to_bytes(image_size, 'big')
+        self.latency = latency
+        self.gzip = gzip
+        # Each of these paths fails once with 503, so that retries are exercised.
+        rng = random.Random(seed)
+        paths = ['/{}/'.format(i) for i in range(1, n + 1)]
+        self.failing = {path for path in paths if rng.random() < error_rate}
+        # These paths fail with 503 until they are removed.
+        self.broken = set()
+        self.lock = threading.Lock()
+
+    def get_page(self, i):
+        prev = '/{}/'.format(i - 1) if i > 1 else '#'
+        next = '/{}/'.format(i + 1) if i < self.n else '#'
+        html = PAGE_TEMPLATE.format(i=i, prev=prev, next=next, filler='')
+        filler = '<li>filler</li>' * max(0, (self.page_size - len(html)) // len('<li>filler</li>'))
+        return PAGE_TEMPLATE.format(i=i, prev=prev, next=next, filler=filler).encode()
+
+    def get(self, path):
+        'Return (status, content type, body)'
+        with self.lock:
+            if path in self.failing:
+                self.failing.remove(path)
+                return (503, 'text/plain', b'try again')
+            if path in self.broken:
+                return (503, 'text/plain', b'try again')
+        parts = path.strip('/').split('/')
+        try:
+            if len(parts) == 1:
+                i = int(parts[0])
+                if 1 <= i <= self.n:
+                    return (200, 'text/html', self.get_page(i))
+            elif len(parts) == 2 and parts[0] == 'img':
+                i = int(parts[1][len('c'):-len('.png')])
+                if 1 <= i <= self.n:
+                    return (200, 'image/png', self.image)
+        except ValueError:
+            pass
+        return (404, 'text/plain', b'not found')
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately, which would otherwise stall keep-alive connections.
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        comic = self.server.comic
+        if comic.latency:
+            time.sleep(comic.latency)
+        status, content_type, body = comic.get(self.path)
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        if (comic.gzip and content_type == 'text/html'
+                and 'gzip' in self.headers.get('Accept-Encoding', '')):
+            body = gzip.compress(body)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_server(comic):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.daemon_threads = True
+    server.comic = comic
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def make_config(base_url):
+    return {
+        'genesis': base_url + '/1/',
+        'url': {'id': {'component': 'path', 'index': 0}},
+        'download': {'url': '{img_url}', 'fpath': 'img/{img_fname}'},
+        'crawl': ['prev', 'next'],
+        'document': {
+            'prev': {'css': 'a[rel~="prev"]', 'attr': 'href'},
+            'next': {'css': 'a[rel~="next"]', 'attr': 'href'},
+            'title': {'css': '#ctitle', 'attr': None},
+            'img_url': {'css': '#comic > img', 'attr': 'src'},
+            'img_fname': {'css': '#comic > img', 'attr': 'src', 'url': {'component': 'path', 'index': 1}},
+            'text': {'css': '#comic > img', 'attr': 'title'},
+        },
+    }
+
+
+def run_crawl(server, out_dir, main_args, fresh=True, check=True):
+    """Crawl the comic of server into out_dir using main.py and return the metrics report of the run.
+
+    Unless fresh is True, the crawl continues from what is already in out_dir.
+    Unless check is True, the run may fail.
+    """
+    base_url = 'http://127.0.0.1:{}'.format(server.server_address[1])
+    if fresh:
+        shutil.rmtree(out_dir, ignore_errors=True)
+        os.makedirs(out_dir)
+    config_path = pjoin(out_dir, 'bench_config.json')
+    with open(config_path, 'w') as fobj:
+        json.dump(make_config(base_url), fobj, indent=4)
+    cmd = [sys.executable, pjoin(BASE_DIR, 'main.py'), out_dir, '--config', config_path,
+        '--verbosity', '1'] + main_args
+    subprocess.run(cmd, check=check, stdout=subprocess.DEVNULL)
+    with open(pjoin(out_dir, 'metrics.json')) as fobj:
+        return json.load(fobj)
+
+
+def print_report(n, report):
+    wall_time = report['wall_time']
+    counters = report['counters']
+    pages = counters.get('pages', 0)
+    print('pages: {}/{}, time: {:.2f} s, {:.1f} pages/s, {:.0f} KB/s'.format(
+        pages, n, wall_time, pages / wall_time, counters.get('wire_bytes', 0) / wall_time / 1000))
+    for stage in STAGES:
+        d = report['timers'].get(stage)
+        if d is not None:
+            print('    {:<10} {:>9.3f} s total {:>9.3f} ms each ({} times)'.format(
+                stage, d['total'], d['total'] / d['count'] * 1000, d['count']))
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000],
+        help='numbers of pages of the comics to crawl')
+    parser.add_argument('--page-size', type=int, default=20000, help='size of each page in bytes')
+    parser.add_argument('--image-size', type=int, default=50000, help='size of each image in bytes')
+    parser.add_argument('--latency', type=float, default=0,
+        help='time in seconds for which the server waits before each response')
+    parser.add_argument('--error-rate', type=float, default=0,
+        help='fraction of pages whose first request fails with status 503')
+    parser.add_argument('--gzip', action='store_true', default=False, help='serve gzip-compressed pages')
+    parser.add_argument('--fail-page', type=int,
+        help='make this page fail with status 503 for a whole run, then check that the next run'
+            ' crawls it and the rest of the comic')
+    parser.add_argument('--keep', help='directory in which to keep the output directories of the runs'
+        ' (by default they are deleted)')
+    args, main_args = parser.parse_known_args()
+    if '--delay' not in main_args:
+        main_args += ['--delay', '0']
+    if '--retry-delay' not in main_args:
+        main_args += ['--retry-delay', '0']
+
+    base_dir = args.keep or tempfile.mkdtemp(prefix='bench_crawl_')
+    status = 0
+    try:
+        for n in args.sizes:
+            comic = SyntheticComic(n, args.page_size, args.image_size, args.latency, args.error_rate, args.gzip)
+            out_dir = pjoin(base_dir, str(n))
+            server = start_server(comic)
+            try:
+                if args.fail_page is not None and 1 <= args.fail_page <= n:
+                    comic.broken.add('/{}/'.format(args.fail_page))
+                    run_crawl(server, out_dir, main_args, check=False)
+                    comic.broken.clear()
+                    report = run_crawl(server, out_dir, main_args, fresh=False)
+                    expected = n - args.fail_page + 1
+                    if report['counters'].get('pages', 0) != expected:
+                        print('resume after failure: expected {} pages, got {}'.format(
+                            expected, report['counters'].get('pages', 0)))
+                        status = 1
+                else:
+                    report = run_crawl(server, out_dir, main_args)
+            finally:
+                server.shutdown()
+                server.server_close()
+            print_report(n, report)
+    finally:
+        if args.keep is None:
+            shutil.rmtree(base_dir)
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark scraping of the raw pages of a project.
+
+Compares evaluating the document config with a CSS selector translation
+per field (as scrape.apply_document_config used to do) against evaluating
+a compiled DocumentPlan, and checks that both give the same info.
+Also reports the time to parse and scrape raw pages, which is all that is needed
+for fields which use regex, since pages are then not parsed.
+"""
+
+from os.path import join as pjoin
+import json
+import time
+from collections import OrderedDict
+
+from lxml import etree
+
+import scrape
+from rawstore import open_raw_store
+
+
+class UncompiledPlan(scrape.DocumentPlan):
+    'Runs document.cssselect once for every field, like scrape did before DocumentPlan'
+
+    def __init__(self, config):
+        super().__init__(config)
+        self.selectors = OrderedDict((d['css'], None) for d in config.values() if 'css' in d)
+
+    def select(self, document):
+        matches = {}
+        for d in self.config.values():
+            if 'css' in d:
+                matches[d['css']] = document.cssselect(d['css'])
+        return matches
+
+
+def load_documents(out_dir, limit=None):
+    'Return a list of (id, raw page, document)'
+    raw_store = open_raw_store(out_dir)
+    documents = []
+    for id in sorted(raw_store.ids()):
+        data = raw_store.get(id)
+        documents.append((id, data, etree.HTML(data)))
+        if limit is not None and len(documents) >= limit:
+            break
+    raw_store.close()
+    return documents
+
+
+def time_scrape(documents, config, apply_fn, repeat):
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        for id, data, document in documents:
+            apply_fn(id, data, document, config)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    import argparse
+    import logging
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('out_dir', help='Output directory of project')
+    parser.add_argument('--config', help='Path to config file (default: out_dir/config.json)')
+    parser.add_argument('--limit', type=int, help='maximum number of raw pages to use')
+    parser.add_argument('--repeat', type=int, default=5, help='number of timed runs (best is reported)')
+    args = parser.parse_args()
+
+    # validation warnings are not interesting here
+    logging.basicConfig(level=logging.ERROR)
+
+    with open(args.config or pjoin(args.out_dir, 'config.json')) as fobj:
+        config = json.load(fobj)
+    document_config = config['document']
+    documents = load_documents(args.out_dir, args.limit)
+    if not documents:
+        print('No raw pages found in', args.out_dir)
+        return 1
+
+    start = time.perf_counter()
+    plan = scrape.compile_document_config(document_config)
+    compile_time = time.perf_counter() - start
+    uncompiled = UncompiledPlan(document_config)
+
+    for id, data, document in documents:
+        info1 = scrape.apply_document_config(id, document, uncompiled, OrderedDict(), data=data)
+        info2 = scrape.apply_document_config(id, document, plan, OrderedDict(), data=data)
+        if info1 != info2:
+            print('Mismatch for {}:\n{}\n{}'.format(id, info1, info2))
+            return 1
+
+    def apply_plan(id, data, document, config):
+        scrape.apply_document_config(id, document, config, data=data)
+
+    def parse_and_apply_plan(id, data, document, config):
+        scrape.scrape_page(id, data, config)
+
+    n = len(documents)
+    before = time_scrape(documents, uncompiled, apply_plan, args.repeat)
+    after = time_scrape(documents, plan, apply_plan, args.repeat)
+    full = time_scrape(documents, plan, parse_and_apply_plan, args.repeat)
+    print('pages: {}, fields: {}, distinct selectors: {}'.format(
+        n, len(document_config), len(plan.selectors)))
+    print('extractors: {}'.format(plan.describe()))
+    print('compile time: {:.3f} ms'.format(compile_time * 1000))
+    print('per-field cssselect: {:.1f} us/page'.format(before / n * 1e6))
+    print('compiled plan:       {:.1f} us/page'.format(after / n * 1e6))
+    print('speedup: {:.2f}x'.format(before / after))
+    print('parse and scrape:    {:.1f} us/page'.format(full / n * 1e6))
+    return 0
+
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(main())
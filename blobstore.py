@@ -0,0 +1,92 @@
+"""
+Content-addressed storage for downloaded resources (like images).
+
+Each distinct content is stored once at out_dir/blobs/<first 2 hex digits>/<sha256>.
+out_dir/blobs/urls.jsonl is an append-only log mapping each downloaded url to the hash of its content,
+so a url which was downloaded before is never fetched again.
+Files in out_dir/site are hard links to blobs (or copies where hard links are not supported),
+so resources which appear at several urls or under several names take up space only once.
+"""
+
+import os
+from os.path import join as pjoin
+import json
+import shutil
+import threading
+import logging
+
+from util import read_json_lines
+
+logger = logging.getLogger('blobstore')
+
+BLOBS_DIRNAME = 'blobs'
+URL_INDEX_FNAME = 'urls.jsonl'
+
+
+class BlobStore:
+
+    def __init__(self, out_dir):
+        self.blobs_dir = pjoin(out_dir, BLOBS_DIRNAME)
+        self.index_path = pjoin(self.blobs_dir, URL_INDEX_FNAME)
+        os.makedirs(self.blobs_dir, exist_ok=True)
+        self.lock = threading.Lock()
+        self.index = {}  # url -> hash
+        for d in read_json_lines(self.index_path):
+            self.index[d['url']] = d['hash']
+        self.index_fobj = open(self.index_path, 'a')
+        self.links_supported = True
+
+    def get_path(self, hash):
+        return pjoin(self.blobs_dir, hash[:2], hash)
+
+    def get_hash(self, url):
+        'Return the hash of the content at url if it was downloaded before and its blob exists'
+        with self.lock:
+            hash = self.index.get(url)
+        if hash is not None and os.path.isfile(self.get_path(hash)):
+            return hash
+        return None
+
+    def put_file(self, url, fpath, hash):
+        'Move the file at fpath, whose content has the given hash, into the store as the content at url'
+        path = self.get_path(hash)
+        if os.path.isfile(path):
+            os.remove(fpath)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(fpath, path)
+        self.add_url(url, hash)
+
+    def add_url(self, url, hash):
+        with self.lock:
+            if self.index.get(url) != hash:
+                self.index[url] = hash
+                self.index_fobj.write(json.dumps({'url': url, 'hash': hash}) + '\n')
+                self.index_fobj.flush()
+
+    def materialize(self, hash, fpath):
+        'Make fpath a hard link to (or a copy of) the blob with the given hash'
+        os.makedirs(os.path.dirname(fpath), exist_ok=True)
+        path = self.get_path(hash)
+        if self.links_supported:
+            try:
+                os.link(path, fpath)
+                return
+            except FileExistsError:
+                os.remove(fpath)
+                os.link(path, fpath)
+                return
+            except OSError:
+                logger.info('Hard links are not supported; copying downloads instead')
+                self.links_supported = False
+        shutil.copyfile(path, fpath)
+
+    def stats(self):
+        'Return the numbers of indexed urls and distinct blobs'
+        with self.lock:
+            return {'urls': len(self.index), 'blobs': len(set(self.index.values()))}
+
+    def close(self):
+        with self.lock:
+            self.index_fobj.close()
+
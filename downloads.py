@@ -0,0 +1,282 @@
+import os
+import re
+import json
+import hashlib
+import queue
+import threading
+import logging
+from collections import OrderedDict
+from urllib.error import HTTPError
+from http.client import HTTPException, IncompleteRead, BadStatusLine
+
+import metrics
+from fetch import TimedFetcher, RETRY_STATUSES
+from util import write_atomic, read_json_lines
+
+logger = logging.getLogger('downloads')
+
+# Append-only log of queued and completed downloads
+DOWNLOADS_FNAME = 'downloads.jsonl'
+
+
+class StreamingDownload:
+    """Download of a url to fpath which is written in chunks, so memory use doesn't depend on its size.
+
+    The body is written to fpath.part and moved into place only when its length matches the one
+    announced by the server, so a file at fpath is always complete.
+    A partial download (left by a failed attempt or an earlier run) is resumed with a Range request
+    if the server gave a validator for it, which is kept in fpath.part.json.
+    """
+
+    PART_SUFFIX = '.part'
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, url, fpath):
+        self.url = url
+        self.fpath = fpath
+        self.part_path = fpath + self.PART_SUFFIX
+        self.meta_path = self.part_path + '.json'
+        self.hash = None
+
+    def get_offset(self):
+        try:
+            return os.path.getsize(self.part_path)
+        except FileNotFoundError:
+            return 0
+
+    def load_meta(self):
+        try:
+            with open(self.meta_path) as fobj:
+                return json.load(fobj)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def get_headers(self):
+        'Return the headers for the next attempt'
+        # Offsets must be those of the file itself, not of a compressed encoding of it.
+        headers = {'Accept-Encoding': 'identity'}
+        offset = self.get_offset()
+        meta = self.load_meta()
+        if offset > 0 and meta.get('url') == self.url and meta.get('if_range'):
+            headers['Range'] = 'bytes={}-'.format(offset)
+            headers['If-Range'] = meta['if_range']
+        return headers
+
+    def read(self, fobj):
+        'Write the body of fobj to the part file'
+        offset = 0
+        if fobj.status == 206:
+            offset, total = parse_content_range(fobj.headers.get('Content-Range'))
+            if offset != self.get_offset():
+                self.discard()
+                raise HTTPException('Content-Range starts at {} instead of {}'.format(offset, self.get_offset()))
+            logger.info('Resuming download at byte {}'.format(offset))
+        else:
+            # The whole body is sent, either because this is the first attempt
+            # or because the resource has changed since the partial download.
+            total = fobj.headers.get('Content-Length')
+            total = int(total) if total is not None and total.isdigit() else None
+            etag = fobj.headers.get('ETag')
+            if_range = etag if etag and not etag.startswith('W/') else fobj.headers.get('Last-Modified')
+            os.makedirs(os.path.dirname(self.part_path), exist_ok=True)
+            with open(self.meta_path, 'w') as meta_fobj:
+                json.dump({'url': self.url, 'if_range': if_range}, meta_fobj)
+
+        h = hashlib.sha256()
+        if offset:
+            with open(self.part_path, 'rb') as part_fobj:
+                for chunk in iter(lambda: part_fobj.read(self.CHUNK_SIZE), b''):
+                    h.update(chunk)
+        with open(self.part_path, 'ab' if offset else 'wb') as part_fobj:
+            while True:
+                chunk = fobj.read(self.CHUNK_SIZE)
+                if not chunk:
+                    break
+                part_fobj.write(chunk)
+                h.update(chunk)
+        size = self.get_offset()
+        if total is not None and size != total:
+            # The part file is kept, so that the next attempt resumes it.
+            raise IncompleteRead(b'', total - size)
+        self.hash = h.hexdigest()
+        return size
+
+    def discard(self):
+        for path in (self.part_path, self.meta_path):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def run(self, fetcher, blob_store=None):
+        try:
+            fetcher.request(self.url, self.read, self.get_headers)
+        except HTTPError as e:
+            if e.code != 416 or self.get_offset() == 0:
+                raise
+            # The part file doesn't fit the resource (it might be longer), so start again.
+            self.discard()
+            fetcher.request(self.url, self.read, self.get_headers)
+        if blob_store is not None:
+            blob_store.put_file(self.url, self.part_path, self.hash)
+            blob_store.materialize(self.hash, self.fpath)
+        else:
+            os.replace(self.part_path, self.fpath)
+        self.discard()
+
+
+def parse_content_range(value):
+    'Return (start, total) from a Content-Range header; total is None if it is unknown'
+    m = re.fullmatch(r'\s*bytes\s+(\d+)-(\d+)/(\d+|\*)\s*', value or '')
+    if m is None:
+        raise BadStatusLine('invalid Content-Range: {!r}'.format(value))
+    return (int(m.group(1)), None if m.group(3) == '*' else int(m.group(3)))
+
+
+def is_permanent_failure(e):
+    'Return whether a download which failed with the HTTPError e would fail again (a client error like 404)'
+    return 400 <= e.code < 500 and e.code not in RETRY_STATUSES
+
+
+def download_to_file(url, fpath, fetcher, blob_store=None):
+    """Download url to fpath (see StreamingDownload).
+
+    If blob_store is given, url is not fetched if it was downloaded before,
+    and fpath is linked to the stored content instead of being written.
+    """
+    if blob_store is not None:
+        hash = blob_store.get_hash(url)
+        if hash is not None:
+            metrics.incr('downloads_deduplicated')
+            blob_store.materialize(hash, fpath)
+            return
+    with metrics.timer('download'):
+        StreamingDownload(url, fpath).run(fetcher, blob_store)
+
+
+class DownloadQueue:
+    """Download resources on background threads.
+
+    Queued downloads (put records) and completed ones (done records) are appended to
+    out_dir/downloads.jsonl, so that downloads which were queued but not completed in one run
+    are resumed in the next run. Downloads which failed with a client error (see is_permanent_failure)
+    get a failed record instead, and are not tried again unless they are queued with a different url.
+    The log is compacted to the pending and failed downloads when it is opened.
+    """
+
+    def __init__(self, out_dir, fetcher=None, workers=1, blob_store=None):
+        self.out_dir = out_dir
+        self.blob_store = blob_store
+        self.path = os.path.join(out_dir, DOWNLOADS_FNAME)
+        self.fetcher = TimedFetcher() if fetcher is None else fetcher
+        self.workers = workers
+        self.pending = OrderedDict()  # fpath (relative to out_dir) -> url
+        self.failed_paths = OrderedDict()  # fpath -> url, for downloads which are not tried again
+        self.failed = 0
+        self.lock = threading.Lock()
+        self.queue = queue.Queue()
+        self.threads = []
+        for d in read_json_lines(self.path):
+            if d['op'] == 'put':
+                self.pending[d['fpath']] = d['url']
+                self.failed_paths.pop(d['fpath'], None)
+            else:
+                self.pending.pop(d['fpath'], None)
+                if d['op'] == 'failed':
+                    self.failed_paths[d['fpath']] = d['url']
+        for fpath, url in self.pending.items():
+            self.queue.put((url, fpath))
+        if self.pending:
+            logger.info('Resuming {} pending downloads'.format(len(self.pending)))
+        write_atomic(self.path, ''.join(
+            [json.dumps({'op': 'failed', 'url': url, 'fpath': fpath}) + '\n'
+                for fpath, url in self.failed_paths.items()] +
+            [json.dumps({'op': 'put', 'url': url, 'fpath': fpath}) + '\n'
+                for fpath, url in self.pending.items()]))
+        self.fobj = open(self.path, 'a')
+
+    def append(self, d):
+        'Must be called with self.lock held'
+        self.fobj.write(json.dumps(d) + '\n')
+        self.fobj.flush()
+
+    def start(self):
+        for i in range(self.workers):
+            name = '{}/download-{}'.format(threading.current_thread().name, i)
+            thread = threading.Thread(target=self.work, name=name, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def put(self, url, fpath):
+        fpath = os.path.relpath(fpath, self.out_dir)
+        with self.lock:
+            if fpath in self.pending or self.failed_paths.get(fpath) == url:
+                return
+            self.failed_paths.pop(fpath, None)
+            self.pending[fpath] = url
+            self.append({'op': 'put', 'url': url, 'fpath': fpath})
+        self.queue.put((url, fpath))
+
+    def work(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                return
+            url, fpath = item
+            try:
+                full_path = os.path.join(self.out_dir, fpath)
+                if not os.path.isfile(full_path):
+                    download_to_file(url, full_path, self.fetcher, self.blob_store)
+            except HTTPError as e:
+                if not is_permanent_failure(e):
+                    logger.exception('Failed to download {}'.format(url))
+                    with self.lock:
+                        self.failed += 1
+                else:
+                    logger.warning('Failed to download {}: HTTP {}; it will not be tried again'.format(url, e.code))
+                    with self.lock:
+                        self.pending.pop(fpath, None)
+                        self.failed_paths[fpath] = url
+                        self.append({'op': 'failed', 'url': url, 'fpath': fpath})
+            except Exception:
+                # The download stays in self.pending, so it will be retried in the next run.
+                logger.exception('Failed to download {}'.format(url))
+                with self.lock:
+                    self.failed += 1
+            else:
+                with self.lock:
+                    self.pending.pop(fpath, None)
+                    self.append({'op': 'done', 'fpath': fpath})
+            finally:
+                self.queue.task_done()
+
+    def __len__(self):
+        with self.lock:
+            return len(self.pending)
+
+    def join(self):
+        'Wait till all queued downloads have been attempted and stop the worker threads'
+        self.queue.join()
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def close(self):
+        """Stop the worker threads once their current downloads are over and close the log.
+
+        Downloads which haven't been attempted are resumed in the next run.
+        """
+        while True:
+            try:
+                self.queue.get_nowait()
+            except queue.Empty:
+                break
+            self.queue.task_done()
+        self.join()
+        with self.lock:
+            self.fobj.close()
+            if not self.pending and not self.failed_paths:
+                os.remove(self.path)
@@ -1,76 +1,600 @@
+import re
+import base64
 import time
-from urllib.request import urlopen, Request
-from urllib.parse import quote
-from http.client import HTTPException
+import random
+import threading
+import zlib
+from collections import deque
+from email.utils import parsedate_to_datetime
+from urllib.parse import quote, unquote, urljoin, urlsplit, urlunsplit
+from urllib.request import getproxies, proxy_bypass_environment
+from urllib.error import HTTPError
+from http.client import HTTPConnection, HTTPSConnection, HTTPException
 import logging
+from contextlib import contextmanager
+
+import metrics
 
 logger = logging.getLogger('fetch')
 
+CHARSET_RE = re.compile(r';\s*charset\s*=\s*["\']?([^"\';\s]+)', re.IGNORECASE)
+# Statuses which mean that the server may be able to handle the request later
+RETRY_STATUSES = (408, 425, 429, 500, 502, 503, 504)
+
 
 class Response:
-    def __init__(self, data, url=None):
+    def __init__(self, data, url=None, status=None, headers=None, truncated=False, charset=None):
         self.data = data
         self.url = url
+        self.status = status
+        self.headers = headers
+        # whether the consumer stopped reading before the end of the body
+        self.truncated = truncated
+        # the parsed document, if the body was parsed while it was being read
+        self.document = None
+        # the charset of the body, if it is known without headers (like for a page from the raw store)
+        self.charset = charset
+
+    def get_charset(self):
+        'Return the charset given by the Content-Type header, or None'
+        if self.charset is not None:
+            return self.charset
+        return get_charset(self.headers)
+
+    def get_validators(self):
+        'Return the headers which can be used to revalidate this response later'
+        validators = {}
+        if self.headers is not None:
+            if self.headers.get('ETag'):
+                validators['etag'] = self.headers['ETag']
+            if self.headers.get('Last-Modified'):
+                validators['last_modified'] = self.headers['Last-Modified']
+        return validators
+
+
+def get_charset(headers):
+    'Return the charset given by the Content-Type header in headers, or None'
+    if headers is None:
+        return None
+    m = CHARSET_RE.search(headers.get('Content-Type') or '')
+    return m.group(1) if m is not None else None
 
 
 def clean_url(url):
     return quote(url, safe="/:=&?#+!$,;'@()*[]")
 
 
+class PooledResponse:
+    'HTTP response whose body is decoded as it is read and whose connection goes back to the pool'
+
+    def __init__(self, pool, key, conn, response, url):
+        self.pool = pool
+        self.key = key
+        self.conn = conn
+        self.response = response
+        self.url = url
+        self.status = response.status
+        self.headers = response.headers
+        encoding = (response.getheader('Content-Encoding') or '').strip().lower()
+        if encoding in ('gzip', 'x-gzip'):
+            self.decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif encoding == 'deflate':
+            self.decoder = zlib.decompressobj(zlib.MAX_WBITS)
+        else:
+            self.decoder = None
+        self.first_chunk = True
+        # number of decoded bytes read so far
+        self.size = 0
+
+    def decode(self, raw):
+        if self.decoder is None:
+            return raw
+        try:
+            return self.decoder.decompress(raw)
+        except zlib.error:
+            # Some servers send raw deflate data without the zlib header.
+            if self.first_chunk:
+                self.decoder = zlib.decompressobj(-zlib.MAX_WBITS)
+                return self.decoder.decompress(raw)
+            raise
+
+    def read(self, amt=None):
+        'Read and decode the next chunk of the body; return b"" only at the end of the body'
+        while True:
+            raw = self.response.read(amt)
+            if not raw:
+                data = self.decoder.flush() if self.decoder is not None else b''
+                self.pool.count_bytes(0, len(data))
+                self.size += len(data)
+                return data
+            data = self.decode(raw)
+            self.first_chunk = False
+            self.pool.count_bytes(len(raw), len(data))
+            self.size += len(data)
+            if data:
+                return data
+
+    def readall(self):
+        chunks = []
+        while True:
+            chunk = self.read()
+            if not chunk:
+                return b''.join(chunks)
+            chunks.append(chunk)
+
+    def close(self):
+        if self.conn is None:
+            return
+        if self.response.isclosed() and not self.response.will_close:
+            self.pool.put(self.key, self.conn)
+        else:
+            self.conn.close()
+        self.conn = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class ConnectionPool:
+    """Keep-alive HTTP connections, shared by all requests to the same host.
+
+    Compressed responses are requested (unless a request has its own Accept-Encoding header)
+    and are transparently decoded.
+    Proxies are taken from the environment (http_proxy, https_proxy and no_proxy) like urlopen does;
+    https urls are tunneled through the proxy with CONNECT.
+    """
+
+    MAX_REDIRECTS = 10
+    ACCEPT_ENCODING = 'gzip, deflate'
+
+    def __init__(self, timeout=None, proxies=None):
+        self.timeout = timeout
+        # scheme -> proxy url, as returned by urllib.request.getproxies
+        self.proxies = getproxies() if proxies is None else proxies
+        self.idle = {}  # (scheme, host, port, proxy url) -> list of idle connections
+        self.lock = threading.Lock()
+        self.new_connections = 0
+        self.reused_connections = 0
+        self.wire_bytes = 0
+        self.decoded_bytes = 0
+
+    def get(self, key):
+        'Return (connection, reused)'
+        with self.lock:
+            conns = self.idle.get(key)
+            if conns:
+                self.reused_connections += 1
+                return (conns.pop(), True)
+            self.new_connections += 1
+        scheme, host, port, proxy = key
+        conn_class = HTTPSConnection if scheme == 'https' else HTTPConnection
+        if proxy is None:
+            return (conn_class(host, port, timeout=self.timeout), False)
+        # Like urlopen, the connection to the proxy itself is never encrypted.
+        proxy_parts = urlsplit(proxy)
+        conn = conn_class(proxy_parts.hostname, proxy_parts.port or 80, timeout=self.timeout)
+        if scheme == 'https':
+            conn.set_tunnel(host, port or 443, headers=get_proxy_headers(proxy))
+        return (conn, False)
+
+    def get_proxy(self, scheme, host):
+        'Return the url of the proxy for requests to host, or None'
+        proxy = self.proxies.get(scheme)
+        if proxy is None or proxy_bypass_environment(host, self.proxies):
+            return None
+        if '://' not in proxy:
+            proxy = 'http://' + proxy
+        return proxy
+
+    def put(self, key, conn):
+        with self.lock:
+            self.idle.setdefault(key, []).append(conn)
+
+    def count_bytes(self, wire_bytes, decoded_bytes):
+        with self.lock:
+            self.wire_bytes += wire_bytes
+            self.decoded_bytes += decoded_bytes
+
+    def close(self):
+        with self.lock:
+            for conns in self.idle.values():
+                for conn in conns:
+                    conn.close()
+            self.idle = {}
+
+    def stats(self):
+        with self.lock:
+            return {
+                'new_connections': self.new_connections,
+                'reused_connections': self.reused_connections,
+                'wire_bytes': self.wire_bytes,
+                'decoded_bytes': self.decoded_bytes,
+            }
+
+    def send(self, url, headers):
+        parts = urlsplit(url)
+        scheme = parts.scheme.lower()
+        if scheme not in ('http', 'https'):
+            raise ValueError('unsupported url scheme: ' + url)
+        proxy = self.get_proxy(scheme, parts.hostname)
+        key = (scheme, parts.hostname, parts.port, proxy)
+        selector = parts.path or '/'
+        if parts.query:
+            selector += '?' + parts.query
+        headers = dict({'Accept-Encoding': self.ACCEPT_ENCODING}, **headers)
+        if proxy is not None and scheme == 'http':
+            # Requests to an HTTP proxy name the whole url.
+            selector = urlunsplit((scheme, parts.netloc, selector, '', ''))
+            headers.update(get_proxy_headers(proxy))
+        while True:
+            conn, reused = self.get(key)
+            try:
+                conn.request('GET', selector, headers=headers)
+                return (key, conn, conn.getresponse())
+            except (OSError, HTTPException):
+                conn.close()
+                # The server may have closed an idle connection; retry once on a new one.
+                if not reused:
+                    raise
+
+    def open(self, url, headers=None):
+        """Send a GET request and return a PooledResponse.
+
+        Redirects are followed. HTTPError is raised for error status codes.
+        """
+        headers = headers or {}
+        for i in range(self.MAX_REDIRECTS + 1):
+            key, conn, response = self.send(url, headers)
+            pooled = PooledResponse(self, key, conn, response, url)
+            location = response.getheader('Location')
+            if response.status in (301, 302, 303, 307, 308) and location:
+                pooled.readall()
+                pooled.close()
+                url = clean_url(urljoin(url, location))
+                continue
+            if response.status >= 400:
+                pooled.readall()
+                pooled.close()
+                raise HTTPError(url, response.status, response.reason, response.headers, None)
+            return pooled
+        raise HTTPError(url, response.status, 'too many redirects', response.headers, None)
+
+
+def get_proxy_headers(proxy):
+    'Return the headers which authenticate with proxy, if its url has credentials'
+    parts = urlsplit(proxy)
+    if parts.username is None:
+        return {}
+    credentials = '{}:{}'.format(unquote(parts.username), unquote(parts.password or ''))
+    return {'Proxy-Authorization': 'Basic ' + base64.b64encode(credentials.encode()).decode('ascii')}
+
+
+def get_retry_after(headers):
+    'Return the number of seconds asked for by the Retry-After header, or None'
+    value = headers.get('Retry-After') if headers is not None else None
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
+    try:
+        return max(0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+def is_retryable(e):
+    'Return whether a failed request may succeed if it is sent again'
+    if isinstance(e, HTTPError):
+        return e.code in RETRY_STATUSES
+    return True
+
+
+class HostThrottle:
+    """Politeness delay between requests to a single host, adapted to how the host responds.
+
+    The request rate is increased after every successful request (additively while the rate is low,
+    by RATE_GROWTH once it is high) and the delay is doubled (halving the rate) when the host
+    signals overload: a 429 or 5xx response, a failed connection or a very slow response.
+    The delay always stays between min_delay and max_delay.
+    A Retry-After header pauses all requests to the host for the given time.
+    """
+
+    # requests per second added to the rate after each successful request
+    RATE_STEP = 0.05
+    # fraction of the rate added after each successful request, if that is more than RATE_STEP
+    RATE_GROWTH = 0.1
+    # delay used when backing off from a delay of 0
+    MIN_BACKOFF_DELAY = 0.5
+    # a response is slow if it takes longer than this many times the average and SLOW_TIME
+    SLOW_FACTOR = 3
+    SLOW_TIME = 1
+    MAX_RETRY_AFTER = 3600
+
+    def __init__(self, host, delay, min_delay=None, max_delay=None):
+        self.host = host
+        self.delay = delay
+        self.min_delay = delay if min_delay is None else min_delay
+        self.max_delay = max(delay, 60) if max_delay is None else max_delay
+        self.last_time = None
+        self.paused_until = None
+        self.latency = None  # moving average of response times
+        self.lock = threading.Lock()
+
+    def wait(self, acquire=None):
+        """Wait till a request may be sent to the host.
+
+        If acquire is given, it is called after waiting and before another request to the host may start.
+        """
+        # The lock is held while sleeping so that concurrent callers are spaced
+        # at least self.delay seconds apart.
+        with self.lock:
+            current_time = time.perf_counter()
+            wake_time = current_time
+            if self.last_time is not None:
+                wake_time = self.last_time + self.delay
+            if self.paused_until is not None:
+                wake_time = max(wake_time, self.paused_until)
+            if wake_time > current_time:
+                time.sleep(wake_time - current_time)
+            if acquire is not None:
+                acquire()
+            self.last_time = time.perf_counter()
+
+    def set_delay(self, delay, reason):
+        'Must be called with self.lock held'
+        delay = min(self.max_delay, max(self.min_delay, delay))
+        if delay > self.delay:
+            logger.info('Slowing down requests to {} ({}): delay {:.2f} -> {:.2f} seconds'.format(
+                self.host, reason, self.delay, delay))
+        elif delay < self.delay:
+            logger.debug('Speeding up requests to {}: delay {:.2f} -> {:.2f} seconds'.format(
+                self.host, self.delay, delay))
+        self.delay = delay
+
+    def on_success(self, elapsed):
+        with self.lock:
+            self.last_time = time.perf_counter()
+            if (self.latency is not None and elapsed > self.SLOW_TIME
+                    and elapsed > self.SLOW_FACTOR * self.latency):
+                self.set_delay(max(self.delay * 2, self.MIN_BACKOFF_DELAY),
+                    'response took {:.1f} seconds'.format(elapsed))
+            elif self.delay > self.min_delay:
+                rate = 1 / self.delay
+                delay = 1 / (rate + max(self.RATE_STEP, rate * self.RATE_GROWTH))
+                # The rate approaches infinity only asymptotically when min_delay is 0.
+                self.set_delay(delay if delay > self.min_delay + 0.001 else self.min_delay, None)
+            self.latency = elapsed if self.latency is None else 0.8 * self.latency + 0.2 * elapsed
+
+    def on_error(self, e, retry_after=None):
+        with self.lock:
+            self.last_time = time.perf_counter()
+            if not is_retryable(e):
+                return
+            self.set_delay(max(self.delay * 2, self.MIN_BACKOFF_DELAY), str(e) or type(e).__name__)
+            if retry_after is not None:
+                retry_after = min(retry_after, self.MAX_RETRY_AFTER)
+                logger.info('Pausing requests to {} for {:.0f} seconds as asked by Retry-After'.format(
+                    self.host, retry_after))
+                self.paused_until = time.perf_counter() + retry_after
+
+
+class FifoSemaphore:
+    'A semaphore which gives free slots to threads in the order in which they started waiting'
+
+    def __init__(self, value):
+        self.value = value
+        self.cond = threading.Condition()
+        self.waiters = deque()
+
+    def acquire(self):
+        ticket = object()
+        with self.cond:
+            self.waiters.append(ticket)
+            while self.waiters[0] is not ticket or self.value == 0:
+                self.cond.wait()
+            self.waiters.popleft()
+            self.value -= 1
+            # The next waiter may be able to take another free slot.
+            self.cond.notify_all()
+
+    def release(self):
+        with self.cond:
+            self.value += 1
+            self.cond.notify_all()
+
+
+class RequestScheduler:
+    """Decides when requests may be sent.
+
+    Requests to each host are spaced by that host's HostThrottle.
+    host_config maps host names to dicts with delay, min_delay and max_delay,
+    which override the defaults for that host (min_delay defaults to delay,
+    so by default requests are never sent faster than delay).
+
+    Optionally, at most max_requests requests are in progress at once, and requests
+    to all hosts together are spaced at least global_delay seconds apart.
+    A scheduler can be shared by several fetchers, even of different projects.
+    Waiting requests get free slots in the order in which they started waiting.
+    """
+
+    def __init__(self, delay, host_config=None, max_requests=None, global_delay=0):
+        self.delay = delay
+        self.host_config = dict(host_config or {})
+        self.throttles = {}
+        self.lock = threading.Lock()
+        self.slots = FifoSemaphore(max_requests) if max_requests else None
+        self.global_delay = global_delay
+        self.global_lock = threading.Lock()
+        self.global_last_time = None
+
+    def add_host_config(self, host_config):
+        'Add config of hosts which are not configured yet'
+        with self.lock:
+            for host, d in (host_config or {}).items():
+                self.host_config.setdefault(host, d)
+
+    def get_throttle(self, url):
+        host = (urlsplit(url).hostname or '').lower()
+        with self.lock:
+            throttle = self.throttles.get(host)
+            if throttle is None:
+                d = self.host_config.get(host, {})
+                throttle = self.throttles[host] = HostThrottle(host, d.get('delay', self.delay),
+                    d.get('min_delay'), d.get('max_delay'))
+            return throttle
+
+    def acquire(self):
+        if self.slots is not None:
+            self.slots.acquire()
+        if self.global_delay:
+            with self.global_lock:
+                current_time = time.perf_counter()
+                if self.global_last_time is not None:
+                    sleep_time = self.global_last_time + self.global_delay - current_time
+                    if sleep_time > 0:
+                        time.sleep(sleep_time)
+                self.global_last_time = time.perf_counter()
+
+    def release(self):
+        if self.slots is not None:
+            self.slots.release()
+
+    @contextmanager
+    def request(self, throttle):
+        'Wait till a request may be sent to the host of throttle and hold a slot while it is in progress'
+        # Time spent waiting for other requests is politeness delay too, so it is included in the timer.
+        with metrics.timer('sleep'):
+            throttle.wait(self.acquire)
+        try:
+            yield
+        finally:
+            self.release()
+
+
 class TimedFetcher:
+    'Fetches urls, retrying failed requests, when the RequestScheduler allows it'
 
     DEFAULT_DELAY = 1
     DEFAULT_RETRY_DELAY = 5
     DEFAULT_RETRIES = 2
+    # Retries wait for retry_delay * 2 ** retry seconds (with jitter), but never longer than this.
+    MAX_RETRY_DELAY = 300
     USER_AGENT = 'webcomic-offliner'
+    TIMEOUT = 60
+    CHUNK_SIZE = 16 * 1024
 
-    def __init__(self, delay=None, retry_delay=None, retries=None):
-        self.last_time = None
+    def __init__(self, delay=None, retry_delay=None, retries=None, pool=None, host_config=None,
+            scheduler=None):
         self.delay = TimedFetcher.DEFAULT_DELAY if delay is None else delay
         self.retry_delay = TimedFetcher.DEFAULT_RETRY_DELAY if retry_delay is None else retry_delay
         self.retries = TimedFetcher.DEFAULT_RETRIES if retries is None else retries
+        if scheduler is None:
+            scheduler = RequestScheduler(self.delay, host_config)
+        self.scheduler = scheduler
         self.count = 0
+        self.lock = threading.Lock()
+        self.pool = ConnectionPool(self.TIMEOUT) if pool is None else pool
 
     def get_current_time(self):
         return time.perf_counter()
 
+    def get_retry_delay(self, retry):
+        'Return the time to wait before retry number retry + 1 (exponential backoff with jitter)'
+        delay = min(self.MAX_RETRY_DELAY, self.retry_delay * 2 ** retry)
+        return random.uniform(delay / 2, delay)
+
     def log_before(self, url, retry):
         if retry == 0:
             logger.info('Fetching: ' + url)
         else:
             logger.info('Fetching (retry {}): {}'.format(retry, url))
 
-    def log_after(self, url, retry, data):
-        # logger.debug('Fetched {} bytes'.format(len(data)))
-        pass
+    def log_after(self, url, retry, size, elapsed):
+        logger.debug('Fetched {} bytes in {:.3f} seconds'.format(size, elapsed))
+
+    def fetch(self, url, validators=None, consumer=None):
+        """Fetch url and return a Response.
+
+        If validators (as returned by Response.get_validators) are given,
+        a conditional request is sent, and the returned response has status 304
+        and empty data if the resource has not been modified.
+
+        If consumer is given, the body is read in chunks and passed to consumer.feed(chunk).
+        When feed returns True, the rest of the body is not read and the response is marked truncated.
+        consumer.reset(charset) is called before every attempt, with the charset given by
+        the Content-Type header of the response (or None).
 
-    def sleep(self):
-        current_time = self.get_current_time()
-        if self.last_time is not None:
-            sleep_time = self.last_time + self.delay - current_time
-            if sleep_time > 0:
-                # logger.debug('sleeping for {:.6f} seconds'.format(sleep_time))
-                time.sleep(sleep_time)
+        Failed requests are retried, except those which failed with a status like 404
+        which won't change by retrying.
+        """
+        headers = {}
+        if validators:
+            if validators.get('etag'):
+                headers['If-None-Match'] = validators['etag']
+            if validators.get('last_modified'):
+                headers['If-Modified-Since'] = validators['last_modified']
 
-    def fetch(self, url):
-        self.sleep()
+        def read(fobj):
+            if consumer is None:
+                return (fobj.readall(), False)
+            return self.read_chunks(fobj, consumer)
+
+        (data, truncated), fobj = self.request(url, read, headers)
+        return Response(data, url=fobj.url, status=fobj.status, headers=fobj.headers, truncated=truncated)
+
+    def request(self, url, read, headers=None):
+        """Send a GET request for url and return (read(fobj), fobj), where fobj is the PooledResponse.
+
+        read is called with the open response of every attempt and should read its body;
+        fobj is closed by the time it is returned, but its url, status and headers can still be used.
+        headers can also be a function which returns the headers for each attempt.
+        Failed attempts (including those in which read raises OSError or HTTPException) are retried,
+        except those which failed with a status like 404 which won't change by retrying.
+        """
         url = clean_url(url)
-        request = Request(url=url, headers={'User-Agent': self.USER_AGENT})
+        throttle = self.scheduler.get_throttle(url)
         for retry in range(self.retries + 1):
-            self.log_before(url, retry)
-            data, url2 = None, None
+            request_headers = {'User-Agent': self.USER_AGENT}
+            request_headers.update((headers() if callable(headers) else headers) or {})
             try:
-                with urlopen(request) as fobj:
-                    data = fobj.read()
-                    url2 = fobj.geturl()
-            except (OSError, IOError, HTTPException):
-                if retry == self.retries:
+                with self.scheduler.request(throttle):
+                    self.log_before(url, retry)
+                    start = self.get_current_time()
+                    with metrics.timer('fetch'), self.pool.open(url, request_headers) as fobj:
+                        result = read(fobj)
+            except (OSError, IOError, HTTPException) as e:
+                metrics.incr('fetch_errors')
+                retry_after = get_retry_after(e.headers) if isinstance(e, HTTPError) else None
+                throttle.on_error(e, retry_after)
+                if retry == self.retries or not is_retryable(e):
                     raise
                 else:
-                    logger.exception('Fetch failed; retrying in {} seconds'.format(self.retry_delay))
-                    time.sleep(self.retry_delay)
+                    retry_delay = max(self.get_retry_delay(retry), retry_after or 0)
+                    logger.exception('Fetch failed; retrying in {:.1f} seconds'.format(retry_delay))
+                    metrics.incr('retries')
+                    with metrics.timer('retry_sleep'):
+                        time.sleep(retry_delay)
                     continue
-            self.count += 1
-            self.log_after(url, data, retry)
-            self.last_time = self.get_current_time()
-            return Response(data, url=url2)
+            end = self.get_current_time()
+            throttle.on_success(end - start)
+            with self.lock:
+                self.count += 1
+            metrics.incr('fetches')
+            self.log_after(url, retry, fobj.size, end - start)
+            return (result, fobj)
+
+    def read_chunks(self, fobj, consumer):
+        'Return (data, truncated)'
+        consumer.reset(get_charset(fobj.headers))
+        chunks = []
+        while True:
+            chunk = fobj.read(self.CHUNK_SIZE)
+            if not chunk:
+                return (b''.join(chunks), False)
+            chunks.append(chunk)
+            if consumer.feed(chunk):
+                return (b''.join(chunks), True)
@@ -0,0 +1,149 @@
+"""
+Crash-safe record of crawl progress.
+
+out_dir/journal.jsonl is an append-only log of JSON records:
+
+* state: a checkpoint of the crawl frontier (pending urls), the next serial number,
+  the ids which have been seen, the ids which must be crawled again and (for a crawl in segments)
+  the serial number from which pages are stitched together at the end. Always the first record.
+* pop: a url was taken from the end of the frontier (with a serial number if it is being crawled).
+* commit: a page was committed, and the urls it links to were added to the frontier.
+* flushed: the info of all pages committed so far has been saved.
+
+Records are buffered and written with a single fsync per batch of pages. Info of committed pages
+is saved only after their commit records are on disk, and is followed by a flushed record.
+On start-up the journal is replayed up to the last flushed record, so the frontier, serial numbers
+and seen ids are restored exactly, and pages committed after it are crawled again.
+"""
+
+import os
+import json
+import time
+import logging
+
+import metrics
+from util import open_atomic, read_json_lines
+
+logger = logging.getLogger('journal')
+
+JOURNAL_FNAME = 'journal.jsonl'
+
+
+class CrawlState:
+
+    def __init__(self, pending_urls, sno, seen_ids=(), redo_ids=(), stitch_sno=None):
+        self.pending_urls = list(pending_urls)
+        self.sno = sno
+        self.seen_ids = set(seen_ids)
+        # ids whose info may be partly saved; they are crawled again even if their info exists
+        self.redo_ids = set(redo_ids)
+        # If several segments are being crawled, the first serial number assigned to them (see segments.py)
+        self.stitch_sno = stitch_sno
+
+
+def replay(records):
+    'Return the CrawlState described by records, or None if there is no state record'
+    if not records or records[0]['op'] != 'state':
+        return None
+    d = records[0]
+    state = CrawlState(d['pending'], d['sno'], d['seen'], d['redo'], d.get('stitch'))
+    last_flushed = max((i for i, d in enumerate(records) if d['op'] == 'flushed'), default=0)
+    in_flight = {}  # sno -> url
+    for d in records[1: last_flushed + 1]:
+        if d['op'] == 'pop':
+            url = state.pending_urls.pop()
+            if d['sno'] is None:
+                state.seen_ids.add(d['id'])
+            else:
+                in_flight[d['sno']] = url
+                state.sno = d['sno'] + 1
+        elif d['op'] == 'commit':
+            del in_flight[d['sno']]
+            state.seen_ids.add(d['id'])
+            state.redo_ids.discard(d['id'])
+            state.pending_urls.extend(d['push'])
+    for d in records[last_flushed + 1:]:
+        if d['op'] == 'commit':
+            state.redo_ids.add(d['id'])
+    # Pages which were being crawled go back to the end of the frontier,
+    # so that they are taken again in the same order and get the same serial numbers.
+    if in_flight:
+        state.sno = min(in_flight)
+        state.pending_urls.extend(in_flight[sno] for sno in sorted(in_flight, reverse=True))
+    return state
+
+
+class CrawlJournal:
+    """Journal of a crawl, which also saves info of committed pages in batches.
+
+    Batches are written when batch_size pages have been committed
+    or when interval seconds have passed since the last batch.
+    """
+
+    BATCH_SIZE = 50
+    INTERVAL = 5
+
+    def __init__(self, out_dir, store, batch_size=None, interval=None):
+        self.path = os.path.join(out_dir, JOURNAL_FNAME)
+        self.store = store
+        self.batch_size = self.BATCH_SIZE if batch_size is None else batch_size
+        self.interval = self.INTERVAL if interval is None else interval
+        self.records = []
+        self.infos = []
+        self.last_flush_time = time.perf_counter()
+        self.fobj = None
+
+    def load(self):
+        'Return the CrawlState saved in the journal, or None if there is no journal'
+        return replay(list(read_json_lines(self.path)))
+
+    def checkpoint(self, state):
+        'Replace the journal with a single state record'
+        self.flush()
+        if self.fobj is not None:
+            self.fobj.close()
+        d = {'op': 'state', 'pending': state.pending_urls, 'sno': state.sno,
+            'seen': sorted(state.seen_ids), 'redo': sorted(state.redo_ids), 'stitch': state.stitch_sno}
+        with open_atomic(self.path, fsync=True) as fobj:
+            fobj.write(json.dumps(d) + '\n')
+        self.fobj = open(self.path, 'a')
+
+    def delete(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+    def pop(self, id, url, sno=None):
+        'Record that url was taken from the end of the frontier; sno is None if it was skipped'
+        self.records.append({'op': 'pop', 'id': id, 'url': url, 'sno': sno})
+
+    def commit(self, info, push):
+        'Record that the page of info was committed and push was added to the frontier'
+        self.records.append({'op': 'commit', 'id': info['id'], 'sno': info['_sno'], 'push': push})
+        self.infos.append(info)
+        if (len(self.infos) >= self.batch_size
+                or time.perf_counter() - self.last_flush_time >= self.interval):
+            self.flush()
+
+    def flush(self):
+        self.last_flush_time = time.perf_counter()
+        if not self.records:
+            return
+        with metrics.timer('journal_sync'):
+            self.fobj.write(''.join(json.dumps(d) + '\n' for d in self.records))
+            self.fobj.flush()
+            os.fsync(self.fobj.fileno())
+        self.records = []
+        if self.infos:
+            self.store.save_many(self.infos)
+            self.infos = []
+            # This record doesn't need to be synced; if it is lost, the batch is just crawled again.
+            self.fobj.write(json.dumps({'op': 'flushed'}) + '\n')
+            self.fobj.flush()
+
+    def close(self):
+        self.flush()
+        if self.fobj is not None:
+            self.fobj.close()
+            self.fobj = None
@@ -6,26 +6,43 @@ Crawl and scrape a website. Originally written for webcomics.
 
 import sys
 import os
+import time
 from os.path import join as pjoin
 import argparse
 import json
-from collections import OrderedDict
+from collections import OrderedDict, deque
 from collections.abc import Sequence
 import logging
 import logging.config
+import threading
 
 import shutil
+from concurrent.futures import Future, ThreadPoolExecutor
 from lxml import etree
 from urllib.parse import urljoin
+from http.client import HTTPException
 
 import scrape
-from scrape import ScrapeError, ConfigError
+from scrape import ScrapeError, ConfigError, url_to_id, get_edges, canonicalize_url
 from fetch import Response, TimedFetcher
+from downloads import DOWNLOADS_FNAME, DownloadQueue, download_to_file
+from blobstore import BlobStore
+from store import STORE_KINDS, open_store
+from rawstore import RAW_STORE_KINDS, open_raw_store, get_raw_meta
+from rescrape import load_document_snapshot, save_document_snapshot
+from journal import CrawlJournal, CrawlState
+from prefetch import Prefetcher
 import theme
+import segments
+import metrics
 
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 logger = logging.getLogger()
+# Time spent in each stage of the last run
+METRICS_FNAME = 'metrics.json'
+# Metrics are saved at least this often (in seconds) during long runs.
+METRICS_SAVE_INTERVAL = 60
 
 
 def configure_logging(out_dir, verbosity):
@@ -44,21 +61,45 @@ def configure_logging(out_dir, verbosity):
     logger.info('')
 
 
-def get_raw_data(url, id=None, out_dir=None, fetcher=None):
+def load_config(config_path):
+    with open(config_path) as fobj:
+        config = json.load(fobj)
+    config['document'] = scrape.compile_document_config(config['document'])
+    config['url'] = scrape.compile_url_config(config['url'])
+    return config
+
+
+def get_raw_data(url, id=None, out_dir=None, fetcher=None, raw_store=None, stream_config=None,
+        prefetcher=None):
+    """Return the Response for url, from the raw store if possible.
+
+    If stream_config (a document config) is given, the page is parsed while it is downloaded,
+    and downloading stops once all fields of stream_config have been found.
+    If prefetcher is given, a page which it is prefetching is waited for.
+    """
     if fetcher is None:
         fetcher = TimedFetcher()
-    if out_dir is None:
-        return fetcher.fetch(url)
+    if prefetcher is not None:
+        prefetcher.claim(url, id)
+    if out_dir is not None:
+        if raw_store is None:
+            raw_store = open_raw_store(out_dir)
+        data = raw_store.get(id)
+        if data is not None:
+            return Response(data, charset=raw_store.get_meta(id).get('charset'))
+
+    if stream_config is None:
+        response = fetcher.fetch(url)
     else:
-        raw_path = pjoin(out_dir, 'raw', id + '.html')
-        if os.path.isfile(raw_path):
-            with open(raw_path, 'rb') as fobj:
-                response = Response(fobj.read())
-        else:
-            response = fetcher.fetch(url)
-            with open(raw_path, 'wb') as fobj:
-                fobj.write(response.data)
-        return response
+        scraper = scrape.StreamingScraper(stream_config)
+        response = fetcher.fetch(url, consumer=scraper)
+        response.document = scraper.close()
+        if response.truncated:
+            logger.debug('Stopped reading {} after {} bytes'.format(url, len(response.data)))
+
+    if out_dir is not None:
+        raw_store.put(id, response.data, get_raw_meta(response))
+    return response
 
 
 def check_path_belongs(fpath, parent_path):
@@ -69,10 +110,10 @@ def check_path_belongs(fpath, parent_path):
         raise ValueError('{} does not lie in {}'.format(fpath, parent_path))
 
 
-def download_resources(url, config, info, out_dir, fetcher=None):
+def download_resources(url, config, info, out_dir, fetcher=None, download_queue=None, blob_store=None):
     if isinstance(config, Sequence):
         for subconfig in config:
-            download_resources(url, subconfig, info, out_dir, fetcher)
+            download_resources(url, subconfig, info, out_dir, fetcher, download_queue, blob_store)
     else:
         info2 = {k: v for k, v in info.items() if v is not None}
         try:
@@ -99,22 +140,21 @@ def download_resources(url, config, info, out_dir, fetcher=None):
         check_path_belongs(fpath, pjoin(out_dir, 'site'))
         fpath = pjoin(out_dir, 'site', fpath)
         if not os.path.isfile(fpath):
-            os.makedirs(os.path.dirname(fpath), exist_ok=True)
-            if fetcher is None:
-                fetcher = TimedFetcher()
-            response = fetcher.fetch(url2)
-            with open(fpath, 'wb') as fobj:
-                fobj.write(response.data)
+            # Urls which were downloaded before are linked right away instead of being queued.
+            if download_queue is not None and (blob_store is None or blob_store.get_hash(url2) is None):
+                download_queue.put(url2, fpath)
+            else:
+                if fetcher is None:
+                    fetcher = TimedFetcher()
+                download_to_file(url2, fpath, fetcher, blob_store)
 
 
-def fetch_and_scrape(url, config, out_dir=None, fetcher=None, download=True, info=None):
-    if info is None:
-        info = OrderedDict()
+def scrape_url(url, config, info):
+    'Apply url config to info and return the id'
     info['_url'] = url
 
     # apply url config
-    for k, d in config['url'].items():
-        info[k] = scrape.apply_url_config(url, d)
+    info.update(scrape.compile_url_config(config['url']).resolve(url))
 
     # get id
     id = info.get('id', None)
@@ -122,82 +162,242 @@ def fetch_and_scrape(url, config, out_dir=None, fetcher=None, download=True, inf
         raise ScrapeError('id is null for url ' + url)
     if id == '':
         raise ScrapeError("id is '' for url " + url)
+    return id
+
+
+def scrape_response(url, response, config, info):
+    info['_url'] = response.url or url
+    plan = scrape.compile_document_config(config['document'])
+    document = response.document
+    if document is None and plan.needs_document:
+        with metrics.timer('parse'):
+            document = etree.HTML(response.data)
+    with metrics.timer('scrape'):
+        scrape.apply_document_config(url, document, plan, info, data=response.data,
+            charset=response.get_charset())
+
+
+def fetch_and_scrape(url, config, out_dir=None, fetcher=None, download=True, info=None,
+        download_queue=None, store=None, raw_store=None, stream=False, blob_store=None, prefetcher=None):
+    if info is None:
+        info = OrderedDict()
+    id = scrape_url(url, config, info)
 
     # get cached info
+    found_info = False
     if out_dir is not None:
-        info_path = pjoin(out_dir, 'info', id + '.json')
-        if os.path.isfile(info_path):
-            with open(info_path) as fobj:
-                info2 = json.load(fobj, object_pairs_hook=OrderedDict)
-                info.update(info2)
+        if store is None:
+            store = open_store(out_dir)
+        info2 = store.load(id)
+        if info2 is not None:
+            info.update(info2)
             found_info = True
-        else:
-            found_info = False
 
     # create info using document
     if not found_info:
-        response = get_raw_data(url, id, out_dir, fetcher)
-        info['_url'] = response.url or url
-        document = etree.HTML(response.data)
-        scrape.apply_document_config(url, document, config['document'], info)
+        response = get_raw_data(url, id, out_dir, fetcher, raw_store,
+            stream_config=config['document'] if stream else None, prefetcher=prefetcher)
+        scrape_response(url, response, config, info)
 
-    # save info
-    if out_dir is not None:
-        info_path = pjoin(out_dir, 'info', id + '.json')
-        with open(info_path, 'w') as fobj:
-            json.dump(info, fobj, indent=4)
+    # Info is saved by the caller once crawl state (_adj) has been added to it.
 
     # download resources
     if download and out_dir is not None and 'download' in config:
-        download_resources(url, config['download'], info, out_dir, fetcher)
+        download_resources(url, config['download'], info, out_dir, fetcher, download_queue, blob_store)
 
     return info
 
 
-def id_exists(id, out_dir, config):
-    fpath = pjoin(out_dir, 'info', id + '.json')
-    return os.path.isfile(fpath)
-
+def crawl_edges(url, info, config, store, seen_ids, explore_old=False, reverse=False):
+    'Set _adj of info and return the urls of adjacent pages which should be crawled'
+    adj = OrderedDict()
+    urls = []
+    for e, id2, url2 in get_edges(url, info, config, reverse=reverse):
+        adj[e] = id2
+        if id2 in seen_ids:
+            continue
+        if explore_old or not store.exists(id2):
+            urls.append(url2)
+    info['_adj'] = adj
+    return urls
+
+
+def update_sinks(config, out_dir, store, raw_store, fetcher, page_template=None, download=True,
+        download_queue=None, reverse=False, render_manifest=None, blob_store=None,
+        index_order=theme.DEFAULT_ORDER, index_fields=None):
+    """Revalidate the first and last pages of an archive using conditional requests.
+
+    Pages which have changed are scraped and rendered again.
+    Return the urls of newly appeared pages and the serial number to assign to the first of them.
+    index_order and index_fields are those of the index, so that its cached entries are reused as they are.
+    """
+    entries = theme.load_index_entries(out_dir, store, index_order, index_fields)
+    sno = max((entry['_sno'] for entry in entries.values()), default=0) + 1
+    prev_sink_ids, next_sink_ids = theme.find_sinks(entries.values())
+    seen_ids = set()
+    pending_urls = []
+    for id in prev_sink_ids + next_sink_ids:
+        if id in seen_ids:
+            continue
+        seen_ids.add(id)
+        info = store.load(id)
+        url = info['_url']
+        try:
+            response = fetcher.fetch(url, raw_store.get_meta(id))
+        except (OSError, HTTPException):
+            logger.exception('Could not revalidate {}'.format(url))
+            continue
+        if response.status == 304:
+            logger.info('Not modified: {}'.format(url))
+            continue
+        meta = get_raw_meta(response)
+        if raw_store.get(id) == response.data:
+            # Storing the same page again would only grow a packed raw store.
+            if raw_store.get_meta(id) != meta:
+                raw_store.put_meta(id, meta)
+            continue
+        raw_store.put(id, response.data, meta)
+        logger.info('Modified: {}'.format(url))
+
+        info2 = OrderedDict()
+        info2['_sno'] = info['_sno']
+        scrape_url(url, config, info2)
+        scrape_response(url, response, config, info2)
+        pending_urls.extend(crawl_edges(url, info2, config, store, seen_ids, reverse=reverse))
+        store.save(info2)
+        if download and 'download' in config:
+            download_resources(url, config['download'], info2, out_dir, fetcher, download_queue, blob_store)
+        if page_template is not None:
+            theme.render_page(page_template, info2, out_dir, force=render_manifest is None,
+                manifest=render_manifest)
+    return (pending_urls, sno)
+
+
+def save_metrics(out_dir, prometheus_path=None):
+    metrics.get_metrics().save(pjoin(out_dir, METRICS_FNAME))
+    if prometheus_path is not None:
+        metrics.get_metrics().save_prometheus(prometheus_path)
+
+
+class SerialExecutor:
+    'Executor which runs each task as soon as it is submitted (used when --workers is 1)'
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except Exception as e:
+            future.set_exception(e)
+        return future
 
-def url_to_id(url, config):
-    return scrape.apply_url_config(url, config['url']['id'])
+    def shutdown(self, wait=True, cancel_futures=False):
+        pass
 
 
-def main():
+def get_parser():
     parser = argparse.ArgumentParser(description=__doc__)
     parser.add_argument('out_dir', help='Output directory of project')
     parser.add_argument('--config', help='Path to config file (file will be copied to out_dir)')
     parser.add_argument('--theme', help='Directory containing theme to apply to generated site')
 
+    parser.add_argument('--store', choices=STORE_KINDS,
+        help='where to keep info objects: json (out_dir/info/<id>.json) or sqlite (out_dir/info.db);'
+            ' by default sqlite is used if out_dir/info.db exists')
+    parser.add_argument('--raw-store', choices=RAW_STORE_KINDS,
+        help='where to keep raw webpages: dir (out_dir/raw/<id>.html) or pack (out_dir/raw.pack);'
+            ' by default pack is used if out_dir/raw.pack exists')
+    parser.add_argument('--stream', action='store_true', default=False,
+        help='parse webpages while downloading them and stop downloading'
+            ' once everything in the document config has been found')
     parser.add_argument('--max-pages', type=int, help='maximum number of pages that will be read')
     parser.add_argument('--delay', type=float, default=1,
         help='time in seconds for which to wait between 2 http requests')
+    parser.add_argument('--retry-delay', type=float,
+        help='time in seconds for which to wait before the first retry of a failed http request;'
+            ' later retries wait exponentially longer (default: {})'.format(TimedFetcher.DEFAULT_RETRY_DELAY))
+    parser.add_argument('--prefetch', type=int, default=0,
+        help='number of pages to fetch ahead of the crawler, by predicting their urls from their ids'
+            ' (only for ids which are numbers in the url path)')
+    parser.add_argument('--workers', type=int, default=1,
+        help='number of pages to fetch and scrape concurrently')
     parser.add_argument('--chip', choices=('soft', 'hard'),
         help='soft: purge last info and generated webpage;'
             ' hard: purge last info, generated webpage and raw webpage')
     parser.add_argument('--reset', action='store_true', default=False,
-        help='reset progress (deletes status.json and sets --explore-old)')
+        help='reset progress (deletes journal.jsonl and sets --explore-old)')
     parser.add_argument('--verbosity', type=int, default=2,
         help='1: print error messages, 2: print fetch messages, 3: print sno')
     parser.add_argument('--explore-old', action='store_true', default=False,
         help='Explore old info files')
+    parser.add_argument('--update', action='store_true', default=False,
+        help='revalidate the first and last pages using conditional requests'
+            ' and crawl only pages which have newly appeared')
 
     parser.add_argument('--index-order', default='sno', help='key for ordering pages for index')
+    parser.add_argument('--index-page-size', type=int, default=theme.INDEX_PAGE_SIZE,
+        help='number of entries in each page of the index (0 for a single page)')
+    parser.add_argument('--index-fields', nargs='+', default=[], metavar='KEY',
+        help='more keys of info which are available to the index template')
     parser.add_argument('--no-index', dest='create_index', action='store_false', default=True,
         help='do not generate index files')
     parser.add_argument('--no-copy-static', dest='copy_static', action='store_false', default=True,
         help='do not copy static files from theme to generated site')
     parser.add_argument('--skip-downloads', dest='download', action='store_false', default=True,
         help='do not download additional content (like images)')
+    parser.add_argument('--download-workers', type=int, default=0,
+        help='number of background threads for downloading additional content'
+            ' (0 means download inline while crawling)')
+    parser.add_argument('--download-delay', type=float,
+        help='time in seconds for which to wait between 2 downloads of additional content'
+            ' when using --download-workers (default: same as --delay)')
     parser.add_argument('--force-render', action='store_true', default=False,
-        help='render pages (using theme) even if pages already exist')
+        help='render pages (using theme) even if they are up to date')
     parser.add_argument('--reverse', action='store_true', default=False,
         help='reverse crawling order')
     parser.add_argument('--sno', type=int, default=1, help='serial number to start with')
     parser.add_argument('--genesis-url', help='override genesis url in config')
-    args = parser.parse_args()
+    parser.add_argument('--seeds', nargs='+', metavar='URL',
+        help='crawl the comic in segments starting at each of these urls at the same time'
+            ' (the first one takes the place of the genesis url)')
+    parser.add_argument('--id-range', nargs=2, type=int, metavar=('START', 'STOP'),
+        help='crawl the comic in segments starting at evenly spaced ids from START to STOP'
+            ' (only for ids which are numbers in the url path)')
+    parser.add_argument('--segments', type=int,
+        help='number of segments to crawl with --id-range (default: --workers)')
+    parser.add_argument('--prometheus-file',
+        help='also save metrics to this file in the Prometheus text format'
+            ' (metrics are always saved to out_dir/{})'.format(METRICS_FNAME))
+    return parser
+
+
+def get_seeds(args, config):
+    'Return the canonical urls from which to start crawling'
+    genesis = args.genesis_url or config['genesis']
+    if args.seeds:
+        seeds = args.seeds
+    elif args.id_range:
+        start, stop = args.id_range
+        seeds = segments.get_id_range_seeds(config, genesis, start, stop, args.segments or args.workers)
+    else:
+        seeds = [genesis]
+    return [canonicalize_url(seed, config.get('trailing_slash')) for seed in seeds]
 
+
+def main():
+    args = get_parser().parse_args()
     configure_logging(args.out_dir, args.verbosity)
+    return crawl(args)['status']
+
+
+def crawl(args, scheduler=None, stop_event=None, save_project_metrics=True):
+    """Crawl, scrape and render the project in args.out_dir.
+
+    Requests are sent when scheduler (a RequestScheduler) allows it; by default each fetcher has its own.
+    Crawling stops early when stop_event (a threading.Event) is set.
+    Return a dict with the exit status and the numbers of pages committed and urls fetched.
+    """
+    args.workers = max(args.workers, 1)
+    summary = {'out_dir': args.out_dir, 'status': 0, 'pages': 0, 'fetches': 0}
 
     if args.config:
         shutil.copyfile(args.config, pjoin(args.out_dir, 'config.json'))
@@ -208,140 +408,258 @@ def main():
         args.index_order = '_sno'
 
     # Load config
-    config_path = pjoin(args.out_dir, 'config.json')
-    with open(config_path) as fobj:
-        config = json.load(fobj)
-    os.makedirs(pjoin(args.out_dir, 'info'), exist_ok=True)
-    os.makedirs(pjoin(args.out_dir, 'raw'), exist_ok=True)
+    config = load_config(pjoin(args.out_dir, 'config.json'))
+    logger.info('Document fields are scraped using {}'.format(config['document'].describe()))
+    if args.stream and config['document'].unstable_keys:
+        logger.warning('--stream: pages are read to the end, since {} may not be found in the start of a page'.format(
+            ', '.join(config['document'].unstable_keys)))
+    store = open_store(args.out_dir, args.store)
+    # Info which already exists may have been scraped with older configs, which are not known.
+    if load_document_snapshot(args.out_dir) is None and not store.ids():
+        save_document_snapshot(args.out_dir, config['document'])
+    raw_store = open_raw_store(args.out_dir, args.raw_store)
+    blob_store = BlobStore(args.out_dir)
 
     # load template and copy static files
     if args.theme is None:
         args.theme = pjoin(BASE_DIR, 'theme')
-    page_template = theme.get_template(args.theme, 'page.html')
+    template_cache_dir = pjoin(args.out_dir, theme.TEMPLATE_CACHE_DIRNAME)
+    page_template = theme.get_template(args.theme, 'page.html', template_cache_dir)
+    if page_template is not None:
+        render_manifest = theme.RenderManifest(args.out_dir,
+            theme.get_template_hash(args.theme, 'page.html', template_cache_dir))
+    else:
+        render_manifest = None
     if args.copy_static:
         theme.copy(pjoin(args.theme, 'static'), pjoin(args.out_dir, 'site'))
 
-    fetcher = TimedFetcher(args.delay)
+    if scheduler is not None:
+        scheduler.add_host_config(config.get('hosts'))
+    fetcher = TimedFetcher(args.delay, args.retry_delay, host_config=config.get('hosts'), scheduler=scheduler)
+
+    # Downloads which were left pending by an earlier run are resumed even without --download-workers.
+    if args.download and (args.download_workers > 0
+            or os.path.isfile(pjoin(args.out_dir, DOWNLOADS_FNAME))):
+        download_delay = args.delay if args.download_delay is None else args.download_delay
+        download_queue = DownloadQueue(args.out_dir,
+            TimedFetcher(download_delay, args.retry_delay, host_config=config.get('hosts'),
+                scheduler=scheduler),
+            workers=max(args.download_workers, 1), blob_store=blob_store)
+        download_queue.start()
+    else:
+        download_queue = None
 
-    # Load and save status
+    # Load progress
+    journal = CrawlJournal(args.out_dir, store)
+    # status.json was used by older versions to record progress.
     status_path = pjoin(args.out_dir, 'status.json')
-    status_path_exists = False
+    state = None
     if args.reset:
         args.explore_old = True
+        journal.delete()
     else:
-        try:
+        state = journal.load()
+        if state is None and os.path.isfile(status_path):
             with open(status_path) as fobj:
                 status = json.load(fobj)
-            status_path_exists = True
-        except FileNotFoundError:
-            pass
-
-    if status_path_exists:
-        url, sno = status['url'], status['sno']
-    else:
-        url, sno = args.genesis_url or config['genesis'], args.sno
-
-    id = url_to_id(url, config)
+            state = CrawlState([status['url']], status['sno'])
+    seeds = get_seeds(args, config)
+    # A crawl in segments which was stopped while stitching them has no pending urls, but is not finished.
+    if state is None or (not state.pending_urls and state.stitch_sno is None):
+        if len(seeds) > 1:
+            logger.info('Crawling {} segments starting at {}'.format(len(seeds), ', '.join(seeds)))
+            # The first seed is taken first, so the stitched serial numbers start with it.
+            state = CrawlState(reversed(seeds), args.sno, stitch_sno=args.sno)
+        else:
+            state = CrawlState(seeds, args.sno)
+    elif args.seeds or args.id_range:
+        logger.warning('Ignoring seeds since this crawl was started by an earlier run (see --reset)')
+    if state.stitch_sno is not None and args.workers < len(state.pending_urls):
+        # Each segment needs a worker to be crawled at the same time as the others.
+        args.workers = len(state.pending_urls)
+        logger.info('Using {} workers'.format(args.workers))
+    if state.redo_ids:
+        logger.info('Crawling {} pages again whose info may not have been saved'.format(len(state.redo_ids)))
+
+    # where the next run starts if this run doesn't commit any page
+    resume_state = CrawlState(state.pending_urls, state.sno, redo_ids=state.redo_ids, stitch_sno=state.stitch_sno)
+
+    url, sno = (state.pending_urls[-1] if state.pending_urls else None), state.sno
     # Chip away latest page
-    if args.chip is not None:
-        paths_to_delete = []
+    if args.chip is not None and url is not None:
+        id = url_to_id(url, config)
         if args.chip == 'hard':
-            paths_to_delete.append(pjoin(args.out_dir, 'raw', id + '.html'))
-        paths_to_delete.append(pjoin(args.out_dir, 'info', id + '.json'))
-        paths_to_delete.append(pjoin(args.out_dir, 'site', id + '.html'))
-        for path in paths_to_delete:
-            try:
-                os.remove(path)
-            except FileNotFoundError:
-                pass
+            raw_store.delete(id)
+        store.delete(id)
+        try:
+            os.remove(pjoin(args.out_dir, 'site', id + '.html'))
+        except FileNotFoundError:
+            pass
 
-    logger.info('Starting at url: {}'.format(url))
+    if args.update:
+        logger.info('Checking first and last pages for updates')
+        pending_urls, sno = update_sinks(config, args.out_dir, store, raw_store, fetcher, page_template,
+            download=args.download, download_queue=download_queue, reverse=args.reverse,
+            render_manifest=render_manifest, blob_store=blob_store,
+            index_order=args.index_order, index_fields=args.index_fields)
+        logger.info('Found {} new pages'.format(len(pending_urls)))
+        state = CrawlState(pending_urls, sno)
+    elif url is not None:
+        logger.info('Starting at url: {}'.format(url))
     logger.info('Starting at sno: {}'.format(sno))
-    pending_urls = [url]
-    if args.explore_old:
-        seen_ids = set()
-    render_count = 0
+    journal.checkpoint(state if state.pending_urls else resume_state)
+    if os.path.isfile(status_path):
+        os.remove(status_path)
+    pending_urls, seen_ids, redo_ids = state.pending_urls, state.seen_ids, state.redo_ids
+    last_committed = None
+    # Pages which have been submitted to the executor but not yet committed,
+    # in the order in which their serial numbers were assigned.
+    in_flight = deque()
+    prefetcher = Prefetcher(config, fetcher, raw_store, args.prefetch) if args.prefetch > 0 else None
+    if args.workers > 1:
+        executor = ThreadPoolExecutor(args.workers,
+            thread_name_prefix=threading.current_thread().name + '/worker')
+    else:
+        executor = SerialExecutor()
 
+    metrics_time = time.perf_counter()
+    crawl_failed = False
     try:
-        while pending_urls and (args.max_pages != 0):
-            url = pending_urls.pop()
-            id = url_to_id(url, config)
-            if args.explore_old:
-                if id in seen_ids:
+        while (pending_urls or in_flight) and not (stop_event is not None and stop_event.is_set()):
+            # Keep the workers busy with pages from the frontier.
+            while pending_urls and len(in_flight) < args.workers and (args.max_pages != 0):
+                url = pending_urls.pop()
+                id = url_to_id(url, config)
+                if id in seen_ids or (not args.explore_old and id not in redo_ids and store.exists(id)):
+                    seen_ids.add(id)
+                    journal.pop(id, url)
                     continue
                 seen_ids.add(id)
-            else:
-                if id_exists(id, args.out_dir, config):
-                    continue
-
-            if args.max_pages is not None:
-                args.max_pages -= 1
-            logger.debug('sno: {}'.format(sno))
-
-            if not status_path_exists:
-                with open(status_path, 'w') as fobj:
-                    json.dump({'url': url, 'sno': sno}, fobj)
-            status_path_exists = False
-
-            info = OrderedDict()
-            info['_sno'] = sno
-            sno += 1
-            fetch_and_scrape(url, config, args.out_dir, fetcher, download=args.download, info=info)
-            adj = OrderedDict()
-
-            empty_urls = ('', '/', '#', '/#')
-            if args.reverse:
-                edges = reversed(config['crawl'])
-            else:
-                edges = config['crawl']
-            for e in edges:
-                url2 = info.get(e)
-                if url2 is None or url2 in empty_urls:
-                    continue
-                id2 = url_to_id(url2, config)
-                adj[e] = id2
-                url2 = urljoin(url, url2)
-                if args.explore_old:
-                    id2_exists = id2 in seen_ids
-                else:
-                    id2_exists = id_exists(id2, args.out_dir, config)
-                if not id2_exists:
-                    pending_urls.append(url2)
-
-            info['_adj'] = adj
-
-            # save info
-            info_path = pjoin(args.out_dir, 'info', id + '.json')
-            with open(info_path, 'w') as fobj:
-                json.dump(info, fobj, indent=4)
-
-            if page_template is not None:
-                output = page_template.render(info)
-                outpath = pjoin(args.out_dir, 'site', info['id'] + '.html')
-                if args.force_render or not os.path.isfile(outpath):
-                    with open(outpath, 'w') as fobj:
-                        fobj.write(output)
-                    render_count += 1
+                journal.pop(id, url, sno)
+
+                if args.max_pages is not None:
+                    args.max_pages -= 1
+                logger.debug('sno: {}'.format(sno))
+
+                info = OrderedDict()
+                info['_sno'] = sno
+                sno += 1
+                future = executor.submit(fetch_and_scrape, url, config, args.out_dir, fetcher,
+                    download=args.download, info=info, download_queue=download_queue, store=store,
+                    raw_store=raw_store, stream=args.stream, blob_store=blob_store, prefetcher=prefetcher)
+                in_flight.append((url, info, future))
+
+            if not in_flight:
+                break
+
+            # Commit pages in the order in which they were submitted,
+            # so that the frontier evolves the same way on every run.
+            # A page stays in in_flight until it is committed, so a crawl which fails on it is not complete.
+            url, info, future = in_flight[0]
+            future.result()
+            urls = crawl_edges(url, info, config, store, seen_ids,
+                explore_old=args.explore_old, reverse=args.reverse)
+            pending_urls.extend(urls)
+            if prefetcher is not None:
+                prefetcher.learn(url, info['id'], urls)
+
+            # Info is saved in batches, after the commit has been recorded in the journal.
+            journal.commit(info, urls)
+            in_flight.popleft()
+            redo_ids.discard(info['id'])
+            last_committed = (url, info['_sno'])
+            metrics.incr('pages')
+            summary['pages'] += 1
+            if save_project_metrics and time.perf_counter() - metrics_time >= METRICS_SAVE_INTERVAL:
+                save_metrics(args.out_dir, args.prometheus_file)
+                metrics_time = time.perf_counter()
+
+            # Pages of a crawl in segments are rendered once they have been stitched.
+            if page_template is not None and state.stitch_sno is None:
+                theme.render_page(page_template, info, args.out_dir, force=args.force_render,
+                    manifest=render_manifest)
+
+        if download_queue is not None:
+            logger.info('Waiting for {} downloads'.format(len(download_queue)))
+            download_queue.join()
+            if download_queue.failed:
+                logger.warning('{} downloads failed; they will be retried in the next run'.format(
+                    download_queue.failed))
     except KeyboardInterrupt:
         pass
     except Exception:
         logger.exception('Caught exception while crawling and scraping')
-        return 1
+        summary['status'] = 1
+        crawl_failed = True
     finally:
+        # Pages which haven't started are dropped, but running workers still write to the stores,
+        # so they are waited for before the stores are closed.
+        executor.shutdown(wait=True, cancel_futures=True)
+        if download_queue is not None:
+            download_queue.close()
+        if prefetcher is not None:
+            unused = prefetcher.close()
+            if unused:
+                logger.info('Kept {} prefetched pages which were not crawled yet'.format(unused))
+        journal.flush()
+        complete = not crawl_failed and not pending_urls and not in_flight
+        if complete and state.stitch_sno is not None:
+            try:
+                last_info = segments.stitch(args.out_dir, store, state.stitch_sno, page_template, render_manifest)
+                if last_info is not None:
+                    last_committed = (last_info['_url'], last_info['_sno'])
+            except Exception:
+                logger.exception('Caught exception while stitching segments; they will be stitched in the next run')
+                summary['status'] = 1
+                complete = False
+        if complete:
+            # The crawl is complete. Like status.json in older versions, the journal is left pointing
+            # at the last page, so that the next run can continue from it (see --chip).
+            if last_committed is not None:
+                resume_state = CrawlState([last_committed[0]], last_committed[1])
+            journal.checkpoint(resume_state)
+        journal.close()
         print()
-        logger.info('Downloaded {} webpages/resources'.format(fetcher.count))
-        logger.info('Rendered {} pages'.format(render_count))
+        fetchers = [fetcher]
+        if download_queue is not None:
+            fetchers.append(download_queue.fetcher)
+        summary['fetches'] = sum(f.count for f in fetchers)
+        logger.info('Downloaded {} webpages/resources'.format(summary['fetches']))
+        pool_stats = [f.pool.stats() for f in fetchers]
+        logger.info('Opened {} new connections and reused {} connections'.format(
+            sum(d['new_connections'] for d in pool_stats), sum(d['reused_connections'] for d in pool_stats)))
+        logger.info('Received {} bytes which decoded to {} bytes'.format(
+            sum(d['wire_bytes'] for d in pool_stats), sum(d['decoded_bytes'] for d in pool_stats)))
+        blob_stats = blob_store.stats()
+        logger.info('Downloaded resources: {} urls stored as {} distinct blobs'.format(
+            blob_stats['urls'], blob_stats['blobs']))
+        for key in ('wire_bytes', 'decoded_bytes'):
+            metrics.incr(key, sum(d[key] for d in pool_stats))
+        if render_manifest is not None:
+            render_manifest.save()
+            logger.info(render_manifest.summary())
+        if save_project_metrics:
+            logger.info(metrics.get_metrics().summary())
+            save_metrics(args.out_dir, args.prometheus_file)
 
     try:
-        if args.theme is not None and args.create_index:
-            found_index = theme.create_index(args.theme, args.out_dir, order=args.index_order)
+        if args.theme is not None and args.create_index and not crawl_failed:
+            with metrics.timer('index'):
+                found_index = theme.create_index(args.theme, args.out_dir, order=args.index_order,
+                    store=store, page_size=args.index_page_size, fields=args.index_fields)
             if found_index:
                 logger.info('Added index')
     except Exception:
         logger.exception('Caught exception while creating index')
-        return 1
+        summary['status'] = 1
+    finally:
+        store.close()
+        raw_store.close()
+        blob_store.close()
+        if save_project_metrics:
+            save_metrics(args.out_dir, args.prometheus_file)
 
-    return 0
+    return summary
 
 
 if __name__ == '__main__':
@@ -0,0 +1,144 @@
+"""
+Timers and counters for measuring where a run spends its time.
+
+Like loggers, metrics are process-wide, so any module can record them
+using the module-level functions timer, add_time and incr.
+Each timer keeps a histogram of its durations, so that a few slow requests
+can be told apart from many slightly slow ones.
+
+A report can be saved as JSON or in the Prometheus text format
+(which can be collected by node_exporter's textfile collector).
+"""
+
+import time
+import json
+import bisect
+import threading
+from contextlib import contextmanager
+
+from util import write_atomic
+
+# Upper bounds (in seconds) of histogram buckets; the last bucket is unbounded.
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+PROMETHEUS_PREFIX = 'webcomic_offliner'
+
+
+class Timer:
+    'Count, total, min, max and histogram of the durations of a stage'
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self.buckets = [0] * (len(BUCKETS) + 1)
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.min = seconds if self.min is None else min(self.min, seconds)
+        self.max = seconds if self.max is None else max(self.max, seconds)
+        self.buckets[bisect.bisect_left(BUCKETS, seconds)] += 1
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'total': self.total,
+            'min': self.min,
+            'max': self.max,
+            # non-cumulative count of durations in each bucket, keyed by upper bound
+            'histogram': {str(le): n for le, n in zip(BUCKETS + ('+Inf',), self.buckets)},
+        }
+
+
+class Metrics:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.start_time = time.perf_counter()
+            self.timers = {}
+            self.counters = {}
+
+    @contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def add_time(self, name, seconds):
+        with self.lock:
+            timer = self.timers.get(name)
+            if timer is None:
+                timer = self.timers[name] = Timer()
+            timer.add(seconds)
+
+    def incr(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def report(self):
+        with self.lock:
+            return {
+                'wall_time': time.perf_counter() - self.start_time,
+                'timers': {name: timer.to_dict() for name, timer in sorted(self.timers.items())},
+                'counters': dict(sorted(self.counters.items())),
+            }
+
+    def summary(self):
+        with self.lock:
+            return 'Time per stage: ' + ', '.join('{} {:.3f} s ({} times)'.format(name, timer.total, timer.count)
+                for name, timer in sorted(self.timers.items()))
+
+    def to_prometheus(self):
+        'Return the report in the Prometheus text exposition format'
+        with self.lock:
+            lines = []
+            name = PROMETHEUS_PREFIX + '_stage_seconds'
+            lines.append('# HELP {} Time spent in each stage.'.format(name))
+            lines.append('# TYPE {} histogram'.format(name))
+            for stage, timer in sorted(self.timers.items()):
+                cumulative = 0
+                for le, n in zip(BUCKETS + ('+Inf',), timer.buckets):
+                    cumulative += n
+                    lines.append('{}_bucket{{stage="{}",le="{}"}} {}'.format(name, stage, le, cumulative))
+                lines.append('{}_sum{{stage="{}"}} {}'.format(name, stage, timer.total))
+                lines.append('{}_count{{stage="{}"}} {}'.format(name, stage, timer.count))
+            for counter, value in sorted(self.counters.items()):
+                name = '{}_{}_total'.format(PROMETHEUS_PREFIX, counter)
+                lines.append('# TYPE {} counter'.format(name))
+                lines.append('{} {}'.format(name, value))
+            name = PROMETHEUS_PREFIX + '_wall_seconds'
+            lines.append('# TYPE {} gauge'.format(name))
+            lines.append('{} {}'.format(name, time.perf_counter() - self.start_time))
+            return '\n'.join(lines) + '\n'
+
+    def save(self, path):
+        write_atomic(path, json.dumps(self.report(), indent=4))
+
+    def save_prometheus(self, path):
+        write_atomic(path, self.to_prometheus())
+
+
+_metrics = Metrics()
+
+
+def get_metrics():
+    return _metrics
+
+
+def timer(name):
+    return _metrics.timer(name)
+
+
+def add_time(name, seconds):
+    _metrics.add_time(name, seconds)
+
+
+def incr(name, n=1):
+    _metrics.incr(name, n)
@@ -0,0 +1,163 @@
+"""
+Speculative prefetching of pages whose urls can be predicted from their ids.
+
+On many webcomics (like xkcd), the id of a page is a number in its url, and the next page
+has the next number. The crawler still has to fetch and scrape a page before it knows
+the url of the next one, so with a Prefetcher, urls are predicted from the urls and ids of
+pages crawled so far and fetched into the raw store ahead of the crawler.
+
+A prediction is only used if the crawler asks for exactly the predicted url, which it takes
+from the scraped links of the previous page. A prefetched page for the id of a different url (a miss)
+is discarded. Pages which have not been claimed when the crawl stops are kept in the raw store,
+where they are found if the pages are crawled in a later run.
+"""
+
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
+from urllib.error import HTTPError
+from http.client import HTTPException
+import threading
+import logging
+
+import metrics
+from fetch import clean_url
+from rawstore import get_raw_meta
+from scrape import url_to_id
+
+logger = logging.getLogger('prefetch')
+
+
+def get_numeric_id_index(config):
+    'Return the index of the path component which is the id, or None if ids are not taken from one'
+    id_config = config['url'].get('id', {})
+    if (id_config.get('component') != 'path' or not isinstance(id_config.get('index'), int)
+            or 'sep' in id_config):
+        return None
+    return id_config['index']
+
+
+def replace_id(url, index, id):
+    'Return url with the path component at index replaced by id, or None if that is not possible'
+    parts = urlparse(url)
+    components = parts.path.strip('/').split('/')
+    try:
+        components[index] = id
+    except IndexError:
+        return None
+    path = '/'.join(components)
+    if parts.path.startswith('/'):
+        path = '/' + path
+    if parts.path.endswith('/') and len(parts.path) > 1:
+        path += '/'
+    return parts._replace(path=path).geturl()
+
+
+class Prefetcher:
+    """Fetches pages which will probably be crawled next into the raw store.
+
+    After a page has been committed, call learn with the urls it added to the frontier.
+    Before fetching a page, call claim, which waits for it to be prefetched.
+    """
+
+    def __init__(self, config, fetcher, raw_store, depth=2):
+        self.config = config
+        self.index = get_numeric_id_index(config)
+        self.fetcher = fetcher
+        self.raw_store = raw_store
+        self.depth = depth
+        self.step = None
+        self.lock = threading.Lock()
+        self.futures = {}  # id -> (clean url, future)
+        self.prefetched = {}  # id -> clean url, for pages which haven't been claimed yet
+        self.claimed = set()  # ids of pages which the crawler fetches itself
+        # Requests are still spaced by the fetcher's throttle, so this only matters when the delay is small.
+        self.executor = ThreadPoolExecutor(depth,
+            thread_name_prefix=threading.current_thread().name + '/prefetch')
+        if self.index is None:
+            logger.warning('Ids are not taken from a path component of urls; prefetching is disabled')
+
+    def predict(self, url, id, step):
+        'Return (id, url) of the page whose id is step more than id, which is the id of url'
+        new_id = int(id) + step
+        if new_id < 0:
+            return None
+        # Ids with leading zeros keep their width.
+        new_id = str(new_id).zfill(len(id))
+        new_url = replace_id(url, self.index, new_id)
+        if new_url is None:
+            return None
+        return (new_id, new_url)
+
+    def learn(self, url, id, urls):
+        'Learn from a committed page with the given url and id, which added urls to the frontier'
+        if self.index is None or id is None or not id.isdigit():
+            return
+        for url2 in urls:
+            id2 = url_to_id(url2, self.config)
+            if id2 is None or not id2.isdigit() or int(id2) == int(id):
+                continue
+            step = int(id2) - int(id)
+            if self.predict(url, id, step) != (id2, url2):
+                continue
+            if step != self.step:
+                logger.info('Predicting urls with ids increasing by {}'.format(step))
+                self.step = step
+            for i in range(self.depth):
+                prediction = self.predict(url2, id2, step * (i + 1))
+                if prediction is not None:
+                    self.submit(*prediction)
+            return
+
+    def submit(self, id, url):
+        url = clean_url(url)
+        with self.lock:
+            if id in self.futures or id in self.prefetched or id in self.claimed:
+                return
+            if self.raw_store.exists(id):
+                return
+            self.futures[id] = (url, self.executor.submit(self.prefetch, id, url))
+
+    def prefetch(self, id, url):
+        metrics.incr('prefetch_requests')
+        try:
+            response = self.fetcher.fetch(url)
+        except (OSError, HTTPException) as e:
+            if not isinstance(e, HTTPError):
+                logger.exception('Could not prefetch {}'.format(url))
+            metrics.incr('prefetch_misses')
+            return
+        self.raw_store.put(id, response.data, get_raw_meta(response))
+        with self.lock:
+            self.prefetched[id] = url
+
+    def claim(self, url, id):
+        """Wait till url is prefetched (if it is being prefetched) and discard a different prefetched page for id.
+
+        Once this returns, nothing is prefetched for id any more, so the crawler can use the raw store.
+        """
+        url = clean_url(url)
+        with self.lock:
+            self.claimed.add(id)
+            predicted_url, future = self.futures.pop(id, (None, None))
+        # A prefetch of a different url with the same id is cancelled, or discarded below if it has started.
+        if future is not None and (predicted_url == url or not future.cancel()):
+            future.result()
+        with self.lock:
+            prefetched_url = self.prefetched.pop(id, None)
+        if prefetched_url is None:
+            return
+        if prefetched_url == url:
+            metrics.incr('prefetch_hits')
+        else:
+            logger.debug('Discarding prefetched {}, since {} was crawled'.format(prefetched_url, url))
+            metrics.incr('prefetch_misses')
+            self.raw_store.delete(id)
+
+    def close(self):
+        'Stop prefetching and return the number of pages which were prefetched but not crawled (they are kept)'
+        self.executor.shutdown(wait=True, cancel_futures=True)
+        with self.lock:
+            unused = len(self.prefetched)
+            self.prefetched = {}
+        return unused
+
@@ -0,0 +1,366 @@
+#!/usr/bin/env python3
+
+"""
+Storage for raw (downloaded) webpages.
+
+Raw pages are stored either as loose files (out_dir/raw/<id>.html, with validators
+in out_dir/raw/<id>.json) or in a packed archive (out_dir/raw.pack).
+
+A packed archive is an append-only sequence of records. Each record holds an id,
+a JSON metadata object (like validators) and the zlib-compressed page.
+A record without a page only replaces the metadata of the latest page with its id.
+out_dir/raw.idx maps each id to the offset of its latest record (and of its latest metadata record).
+It is a JSON snapshot of the index on its first line, followed by a line for each record appended since then;
+it is compacted to a single snapshot when the store is opened or closed. Records which the index
+doesn't know about (after a crash) are found by scanning the end of the archive.
+Records are read using mmap.
+"""
+
+import os
+from os.path import join as pjoin
+import json
+import mmap
+import struct
+import threading
+import zlib
+import logging
+
+from util import open_atomic, read_json_lines
+
+logger = logging.getLogger('rawstore')
+
+PACK_FNAME = 'raw.pack'
+INDEX_FNAME = 'raw.idx'
+RAW_STORE_KINDS = ('dir', 'pack')
+
+
+class DirRawStore:
+    'Stores each raw page at out_dir/raw/<id>.html and its metadata at out_dir/raw/<id>.json'
+
+    kind = 'dir'
+
+    def __init__(self, out_dir):
+        self.raw_dir = pjoin(out_dir, 'raw')
+        os.makedirs(self.raw_dir, exist_ok=True)
+
+    def get(self, id):
+        'Return the raw page with the given id or None if it does not exist'
+        try:
+            with open(pjoin(self.raw_dir, id + '.html'), 'rb') as fobj:
+                return fobj.read()
+        except FileNotFoundError:
+            return None
+
+    def get_meta(self, id):
+        try:
+            with open(pjoin(self.raw_dir, id + '.json')) as fobj:
+                return json.load(fobj)
+        except FileNotFoundError:
+            return {}
+
+    def exists(self, id):
+        return os.path.isfile(pjoin(self.raw_dir, id + '.html'))
+
+    def put(self, id, data, meta=None):
+        with open(pjoin(self.raw_dir, id + '.html'), 'wb') as fobj:
+            fobj.write(data)
+        meta_path = pjoin(self.raw_dir, id + '.json')
+        if meta:
+            with open(meta_path, 'w') as fobj:
+                json.dump(meta, fobj)
+        elif os.path.isfile(meta_path):
+            os.remove(meta_path)
+
+    def put_meta(self, id, meta):
+        'Replace the metadata of the page with the given id, which must exist'
+        with open(pjoin(self.raw_dir, id + '.json'), 'w') as fobj:
+            json.dump(meta, fobj)
+
+    def delete(self, id):
+        for ext in ('.html', '.json'):
+            try:
+                os.remove(pjoin(self.raw_dir, id + ext))
+            except FileNotFoundError:
+                pass
+
+    def ids(self):
+        if not os.path.isdir(self.raw_dir):
+            return []
+        return [fname[:-len('.html')] for fname in os.listdir(self.raw_dir) if fname.endswith('.html')]
+
+    def close(self):
+        pass
+
+
+class PackRawStore:
+    """Stores raw pages in an append-only compressed archive at out_dir/raw.pack.
+
+    Pages which are not in the archive are looked up in out_dir/raw,
+    so a partially migrated project keeps working.
+    A store opened with readonly=True never writes to the archive or the index,
+    so it can be used by several processes at once.
+    """
+
+    kind = 'pack'
+
+    MAGIC = b'WCR1'
+    # magic, flags, id length, meta length, compressed data length
+    HEADER = struct.Struct('>4sBHII')
+    FLAG_DELETED = 1
+    FLAG_META = 2
+
+    def __init__(self, out_dir, readonly=False):
+        self.path = pjoin(out_dir, PACK_FNAME)
+        self.index_path = pjoin(out_dir, INDEX_FNAME)
+        self.readonly = readonly
+        self.fallback = DirRawStore(out_dir)
+        self.lock = threading.Lock()
+        self.fobj = open(self.path, 'rb' if readonly else 'a+b')
+        self.mmap = None
+        self.mmap_size = 0
+        self.index_fobj = None
+        self.index = {}  # id -> offset of latest record with a page
+        self.meta_index = {}  # id -> offset of latest metadata record, if it is newer than the page
+        indexed_size = self.load_index()
+        size = os.path.getsize(self.path)
+        if indexed_size > size:
+            logger.warning('{} is stale; rebuilding it'.format(self.index_path))
+            self.index, self.meta_index, indexed_size = {}, {}, 0
+        if indexed_size < size:
+            self.scan(indexed_size, size)
+        if not readonly:
+            self.save_index()
+
+    def load_index(self):
+        'Load the snapshot and the later records of the index and return the size of the archive it covers'
+        records = read_json_lines(self.index_path)
+        try:
+            d = next(records)
+            self.index, self.meta_index, indexed_size = d['index'], d.get('meta_index', {}), d['size']
+            with self.lock:
+                for d in records:
+                    self.update_index(d['id'], d['offset'], d['flags'])
+                    indexed_size = d['end']
+        except (StopIteration, KeyError):
+            self.index, self.meta_index, indexed_size = {}, {}, 0
+        return indexed_size
+
+    def get_view(self, end):
+        'Must be called with self.lock held. Return a mmap which covers bytes [0, end)'
+        if self.mmap is None or self.mmap_size < end:
+            if self.mmap is not None:
+                self.mmap.close()
+            self.fobj.flush()
+            self.mmap_size = os.path.getsize(self.path)
+            self.mmap = mmap.mmap(self.fobj.fileno(), self.mmap_size, access=mmap.ACCESS_READ)
+        return self.mmap
+
+    def read_record(self, offset, with_data=True):
+        'Must be called with self.lock held. Return (flags, id, meta, data, next offset)'
+        view = self.get_view(offset + self.HEADER.size)
+        magic, flags, id_len, meta_len, data_len = self.HEADER.unpack_from(view, offset)
+        if magic != self.MAGIC:
+            raise ValueError('corrupt record at offset {} in {}'.format(offset, self.path))
+        start = offset + self.HEADER.size
+        end = start + id_len + meta_len + data_len
+        view = self.get_view(end)
+        if end > self.mmap_size:
+            raise ValueError('truncated record at offset {} in {}'.format(offset, self.path))
+        id = view[start: start + id_len].decode()
+        meta = json.loads(view[start + id_len: start + id_len + meta_len].decode())
+        data = None
+        if with_data and not flags & (self.FLAG_DELETED | self.FLAG_META):
+            data = zlib.decompress(view[start + id_len + meta_len: end])
+        return (flags, id, meta, data, end)
+
+    def scan(self, start, end):
+        'Add records in bytes [start, end) of the archive to the index'
+        with self.lock:
+            offset = start
+            while offset < end:
+                try:
+                    flags, id, meta, data, next_offset = self.read_record(offset, with_data=False)
+                except (ValueError, struct.error):
+                    # The last record is cut short if a crash interrupted appending it.
+                    if self.readonly:
+                        break
+                    logger.warning('Truncating partial record at offset {} in {}'.format(offset, self.path))
+                    self.fobj.truncate(offset)
+                    if self.mmap is not None:
+                        self.mmap.close()
+                        self.mmap = None
+                    break
+                self.update_index(id, offset, flags)
+                offset = next_offset
+
+    def save_index(self):
+        'Replace the index with a snapshot, to which later records are appended'
+        with self.lock:
+            self.fobj.seek(0, os.SEEK_END)
+            d = {'size': self.fobj.tell(), 'index': self.index, 'meta_index': self.meta_index}
+            if self.index_fobj is not None:
+                self.index_fobj.close()
+            with open_atomic(self.index_path) as fobj:
+                fobj.write(json.dumps(d) + '\n')
+            self.index_fobj = open(self.index_path, 'a')
+
+    def append(self, id, meta, data, flags=0):
+        id_bytes = id.encode()
+        meta_bytes = json.dumps(meta or {}).encode()
+        data_bytes = b'' if data is None else zlib.compress(data)
+        header = self.HEADER.pack(self.MAGIC, flags, len(id_bytes), len(meta_bytes), len(data_bytes))
+        with self.lock:
+            self.fobj.seek(0, os.SEEK_END)
+            offset = self.fobj.tell()
+            self.fobj.write(header + id_bytes + meta_bytes + data_bytes)
+            self.update_index(id, offset, flags)
+            # The record goes to disk before the index mentions it.
+            self.fobj.flush()
+            end = offset + len(header) + len(id_bytes) + len(meta_bytes) + len(data_bytes)
+            self.index_fobj.write(json.dumps({'id': id, 'offset': offset, 'flags': flags, 'end': end}) + '\n')
+            self.index_fobj.flush()
+
+    def update_index(self, id, offset, flags):
+        'Must be called with self.lock held. Add the record at offset to the index'
+        if flags & self.FLAG_META:
+            self.meta_index[id] = offset
+            return
+        self.meta_index.pop(id, None)
+        if flags & self.FLAG_DELETED:
+            self.index.pop(id, None)
+        else:
+            self.index[id] = offset
+
+    def get_record(self, id, with_data=True):
+        with self.lock:
+            offset = self.index.get(id)
+            if offset is None:
+                return None
+            return self.read_record(offset, with_data)
+
+    def get(self, id):
+        record = self.get_record(id)
+        if record is None:
+            return self.fallback.get(id)
+        return record[3]
+
+    def get_meta(self, id):
+        with self.lock:
+            offset = self.meta_index.get(id, self.index.get(id))
+            if offset is None:
+                return self.fallback.get_meta(id)
+            return self.read_record(offset, with_data=False)[2]
+
+    def exists(self, id):
+        with self.lock:
+            if id in self.index:
+                return True
+        return self.fallback.exists(id)
+
+    def put(self, id, data, meta=None):
+        self.append(id, meta, data)
+
+    def put_meta(self, id, meta):
+        'Replace the metadata of the page with the given id, which must exist, without storing the page again'
+        with self.lock:
+            packed = id in self.index
+        if packed:
+            self.append(id, meta, None, flags=self.FLAG_META)
+        else:
+            self.fallback.put_meta(id, meta)
+
+    def delete(self, id):
+        if self.get_record(id, with_data=False) is not None:
+            self.append(id, None, None, flags=self.FLAG_DELETED)
+        self.fallback.delete(id)
+
+    def ids(self):
+        with self.lock:
+            ids = set(self.index)
+        ids.update(self.fallback.ids())
+        return list(ids)
+
+    def close(self):
+        if not self.readonly:
+            self.save_index()
+        with self.lock:
+            if self.index_fobj is not None:
+                self.index_fobj.close()
+                self.index_fobj = None
+            if self.mmap is not None:
+                self.mmap.close()
+                self.mmap = None
+            self.fobj.close()
+
+
+def get_raw_meta(response):
+    'Return the metadata which is saved with the raw data of response'
+    # Validators (ETag and Last-Modified) are saved so that the page can be revalidated later.
+    meta = response.get_validators()
+    # The charset from the Content-Type header is needed to decode the page for regex fields.
+    charset = response.get_charset()
+    if charset is not None:
+        meta['charset'] = charset
+    if response.truncated:
+        meta['truncated'] = True
+    return meta
+
+
+def open_raw_store(out_dir, kind=None, readonly=False):
+    """Open the raw page store of a project.
+
+    If kind is None, the packed archive is used if out_dir/raw.pack exists,
+    otherwise loose files in out_dir/raw are used.
+    """
+    if kind is None:
+        kind = 'pack' if os.path.isfile(pjoin(out_dir, PACK_FNAME)) else 'dir'
+    if kind == 'pack':
+        return PackRawStore(out_dir, readonly=readonly)
+    elif kind == 'dir':
+        return DirRawStore(out_dir)
+    else:
+        raise ValueError('unknown raw store: {}'.format(kind))
+
+
+def migrate(out_dir, delete=False):
+    'Move loose raw pages of out_dir into the packed archive and return the number moved'
+    dir_store = DirRawStore(out_dir)
+    pack_store = PackRawStore(out_dir)
+    count = 0
+    for id in sorted(dir_store.ids()):
+        pack_store.put(id, dir_store.get(id), dir_store.get_meta(id))
+        count += 1
+    pack_store.close()
+    if delete:
+        for id in dir_store.ids():
+            dir_store.delete(id)
+    return count
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='Manage the packed raw page archive of a project')
+    parser.add_argument('command', choices=('migrate', 'reindex'),
+        help='migrate: move out_dir/raw/*.html into out_dir/raw.pack;'
+            ' reindex: rebuild out_dir/raw.idx by scanning out_dir/raw.pack')
+    parser.add_argument('out_dir', help='Output directory of project')
+    parser.add_argument('--delete', action='store_true', default=False,
+        help='delete loose raw pages after migrating them')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    if args.command == 'migrate':
+        count = migrate(args.out_dir, delete=args.delete)
+        logger.info('Migrated {} raw pages'.format(count))
+    else:
+        try:
+            os.remove(pjoin(args.out_dir, INDEX_FNAME))
+        except FileNotFoundError:
+            pass
+        pack_store = PackRawStore(args.out_dir)
+        logger.info('Indexed {} raw pages'.format(len(pack_store.index)))
+        pack_store.close()
+
+
+if __name__ == '__main__':
+    main()
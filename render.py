@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+
+"""
+Render the generated site of a project from its existing info, without crawling.
+
+Pages are rendered in parallel by a pool of processes which share
+a compiled template cache in out_dir/template_cache.
+"""
+
+import os
+from os.path import join as pjoin
+import sys
+import logging
+
+import theme
+from store import STORE_KINDS, open_store
+from util import worker_state, map_chunks
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+logger = logging.getLogger('render')
+
+
+def init_worker(theme_dir, out_dir, store_kind, template_hash):
+    cache_dir = pjoin(out_dir, theme.TEMPLATE_CACHE_DIRNAME)
+    worker_state['template'] = theme.get_template(theme_dir, 'page.html', cache_dir)
+    worker_state['store'] = open_store(out_dir, store_kind)
+    worker_state['manifest'] = theme.RenderManifest(out_dir, template_hash)
+    worker_state['out_dir'] = out_dir
+
+
+def render_ids(ids, force=False):
+    """Render pages with the given ids in a worker process.
+
+    Return the manifest entries of rendered pages and the skipped, rendered and stale counts.
+    """
+    manifest = worker_state['manifest']
+    manifest.skipped = manifest.rendered = manifest.stale = 0
+    entries = {}
+    for id in ids:
+        info = worker_state['store'].load(id)
+        if info is None:
+            continue
+        if theme.render_page(worker_state['template'], info, worker_state['out_dir'], force, manifest):
+            entries[id] = manifest.entries[id]
+    return (entries, manifest.skipped, manifest.rendered, manifest.stale)
+
+
+def render_all(theme_dir, out_dir, store_kind=None, workers=None, force=False, chunk_size=100):
+    """Render all pages of a project which are missing or out of date.
+
+    Return the RenderManifest, which has counts of skipped, rendered and stale pages.
+    """
+    store = open_store(out_dir, store_kind)
+    ids = sorted(store.ids())
+    store_kind = store.kind
+    store.close()
+    os.makedirs(pjoin(out_dir, 'site'), exist_ok=True)
+    cache_dir = pjoin(out_dir, theme.TEMPLATE_CACHE_DIRNAME)
+    # Compile templates once up front, so that worker processes find them in the bytecode cache.
+    if theme.get_template(theme_dir, 'page.html', cache_dir) is None:
+        return None
+    template_hash = theme.get_template_hash(theme_dir, 'page.html', cache_dir)
+    manifest = theme.RenderManifest(out_dir, template_hash)
+    try:
+        for result in map_chunks(render_ids, ids, chunk_size, workers, init_worker,
+                (theme_dir, out_dir, store_kind, template_hash), force):
+            manifest.update(*result)
+    finally:
+        manifest.save()
+    return manifest
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('out_dir', help='Output directory of project')
+    parser.add_argument('--theme', help='Directory containing theme to apply to generated site')
+    parser.add_argument('--store', choices=STORE_KINDS,
+        help='where info objects are kept (by default sqlite is used if out_dir/info.db exists)')
+    parser.add_argument('--workers', type=int,
+        help='number of rendering processes (default: number of CPUs)')
+    parser.add_argument('--chunk-size', type=int, default=100,
+        help='number of pages given to a rendering process at a time')
+    parser.add_argument('--force', action='store_true', default=False,
+        help='render pages even if they are up to date')
+    parser.add_argument('--index-order', default='sno', help='key for ordering pages for index')
+    parser.add_argument('--index-page-size', type=int, default=theme.INDEX_PAGE_SIZE,
+        help='number of entries in each page of the index (0 for a single page)')
+    parser.add_argument('--index-fields', nargs='+', default=[], metavar='KEY',
+        help='more keys of info which are available to the index template')
+    parser.add_argument('--no-index', dest='create_index', action='store_false', default=True,
+        help='do not generate index files')
+    parser.add_argument('--no-copy-static', dest='copy_static', action='store_false', default=True,
+        help='do not copy static files from theme to generated site')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+
+    if args.theme is None:
+        args.theme = pjoin(BASE_DIR, 'theme')
+    if args.index_order in ('none', 'null'):
+        args.index_order = None
+    if args.index_order == 'sno':
+        args.index_order = '_sno'
+
+    if args.copy_static:
+        theme.copy(pjoin(args.theme, 'static'), pjoin(args.out_dir, 'site'))
+    manifest = render_all(args.theme, args.out_dir, args.store, args.workers, args.force, args.chunk_size)
+    if manifest is None:
+        return 1
+    logger.info(manifest.summary())
+    if args.create_index:
+        if theme.create_index(args.theme, args.out_dir, order=args.index_order,
+                page_size=args.index_page_size, fields=args.index_fields):
+            logger.info('Added index')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
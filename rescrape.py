@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+
+"""
+Scrape the raw pages of a project again, without crawling.
+
+This is useful after changing the document section of a project's config.
+Raw pages are scraped in parallel by a pool of processes, and the results are merged
+into the existing info objects (_sno, _url and other crawl state are kept).
+"""
+
+from os.path import join as pjoin
+import sys
+import json
+import logging
+from collections import OrderedDict
+
+import scrape
+from store import STORE_KINDS, open_store
+from rawstore import open_raw_store
+from util import worker_state, write_atomic, map_chunks
+
+logger = logging.getLogger('rescrape')
+
+# The document config which info was last scraped with
+DOCUMENT_SNAPSHOT_FNAME = 'document_config.json'
+
+
+def load_document_snapshot(out_dir):
+    try:
+        with open(pjoin(out_dir, DOCUMENT_SNAPSHOT_FNAME)) as fobj:
+            return json.load(fobj, object_pairs_hook=OrderedDict)
+    except FileNotFoundError:
+        return None
+
+
+def save_document_snapshot(out_dir, document_config, keys=None):
+    'Record that info was scraped with document_config, or only with its given keys'
+    if isinstance(document_config, scrape.DocumentPlan):
+        document_config = document_config.config
+    if keys is not None:
+        # Other keys were scraped with the config in the old snapshot, if there is one.
+        snapshot = load_document_snapshot(out_dir) or OrderedDict()
+        for k in keys:
+            snapshot[k] = document_config[k]
+        document_config = snapshot
+    write_atomic(pjoin(out_dir, DOCUMENT_SNAPSHOT_FNAME), json.dumps(document_config, indent=4))
+
+
+def get_changed_keys(old_config, new_config):
+    'Return keys of new_config whose scrape config is not the same in old_config'
+    if old_config is None:
+        return list(new_config)
+    return [k for k, d in new_config.items() if old_config.get(k) != d]
+
+
+def init_worker(out_dir, raw_store_kind, document_config):
+    worker_state['raw_store'] = open_raw_store(out_dir, raw_store_kind, readonly=True)
+    worker_state['plan'] = scrape.compile_document_config(document_config)
+    # validation warnings were already logged when these pages were first scraped
+    logging.getLogger('scrape').setLevel(logging.ERROR)
+
+
+def rescrape_ids(ids):
+    """Scrape raw pages with the given ids in a worker process.
+
+    Return a list of (id, result, truncated).
+    """
+    results = []
+    raw_store = worker_state['raw_store']
+    for id in ids:
+        data = raw_store.get(id)
+        if data is None:
+            continue
+        meta = raw_store.get_meta(id)
+        result = scrape.scrape_page(id, data, worker_state['plan'], charset=meta.get('charset'))
+        results.append((id, result, meta.get('truncated', False)))
+    return results
+
+
+def merge_result(info, result, keys, config):
+    'Merge the scraped values of keys into info and return whether info changed'
+    old_info = json.dumps(info)
+    for k in keys:
+        info[k] = result.get(k)
+    scrape_errors = OrderedDict((k, v) for k, v in info.pop('_scrape_errors', {}).items() if k not in keys)
+    scrape_errors.update(result.get('_scrape_errors', {}))
+    if scrape_errors:
+        info['_scrape_errors'] = scrape_errors
+    if '_adj' in info and set(keys) & set(config['crawl']):
+        info['_adj'] = OrderedDict((e, id2) for e, id2, url2 in scrape.get_edges(info['_url'], info, config))
+    return json.dumps(info) != old_info
+
+
+def rescrape(out_dir, config, keys=None, store_kind=None, workers=None, chunk_size=100):
+    """Scrape keys of all cached raw pages again and save changed info.
+
+    If keys is None, all keys of the document config are scraped.
+    Return the numbers of info objects which were changed and unchanged.
+    """
+    document_config = config['document']
+    if keys is None:
+        keys = list(document_config)
+    for k in keys:
+        if k not in document_config:
+            raise scrape.ConfigError('{} is not in the document config'.format(k))
+    sub_config = OrderedDict((k, document_config[k]) for k in keys)
+    logger.info('Scraping fields using {}'.format(scrape.compile_document_config(sub_config).describe()))
+
+    store = open_store(out_dir, store_kind)
+    ids = sorted(store.ids())
+    # Opening the raw store here brings its index up to date before workers use it.
+    raw_store = open_raw_store(out_dir)
+    raw_store_kind = raw_store.kind
+    raw_store.close()
+
+    changed, unchanged, truncated_count = 0, 0, 0
+    try:
+        for results in map_chunks(rescrape_ids, ids, chunk_size, workers, init_worker,
+                (out_dir, raw_store_kind, sub_config)):
+            changed_infos = []
+            for id, result, truncated in results:
+                truncated_count += truncated
+                info = store.load(id)
+                if merge_result(info, result, keys, config):
+                    changed_infos.append(info)
+                else:
+                    unchanged += 1
+            store.save_many(changed_infos)
+            changed += len(changed_infos)
+    finally:
+        store.close()
+    if truncated_count:
+        # Pages downloaded with --stream end once the fields configured at that time were found.
+        logger.warning('{} raw pages were only partly downloaded;'
+            ' fields which appear later in these pages were not found'.format(truncated_count))
+    return (changed, unchanged)
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('out_dir', help='Output directory of project')
+    parser.add_argument('--config', help='Path to config file (default: out_dir/config.json)')
+    parser.add_argument('--store', choices=STORE_KINDS,
+        help='where info objects are kept (by default sqlite is used if out_dir/info.db exists)')
+    parser.add_argument('--workers', type=int,
+        help='number of scraping processes (default: number of CPUs)')
+    parser.add_argument('--chunk-size', type=int, default=100,
+        help='number of pages given to a scraping process at a time')
+    parser.add_argument('--keys', nargs='+', help='keys of the document config to scrape again')
+    parser.add_argument('--changed', action='store_true', default=False,
+        help='only scrape keys whose document config has changed since info was last scraped'
+            ' (as recorded in out_dir/{})'.format(DOCUMENT_SNAPSHOT_FNAME))
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+
+    with open(args.config or pjoin(args.out_dir, 'config.json')) as fobj:
+        config = json.load(fobj, object_pairs_hook=OrderedDict)
+    config['url'] = scrape.compile_url_config(config['url'])
+    keys = args.keys
+    if args.changed:
+        keys = get_changed_keys(load_document_snapshot(args.out_dir), config['document'])
+        if not keys:
+            logger.info('Document config has not changed')
+            return 0
+    if keys is not None:
+        logger.info('Scraping keys: {}'.format(', '.join(keys)))
+
+    changed, unchanged = rescrape(args.out_dir, config, keys, args.store, args.workers, args.chunk_size)
+    save_document_snapshot(args.out_dir, config['document'], keys)
+    logger.info('Updated {} info objects; {} were unchanged'.format(changed, unchanged))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
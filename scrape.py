@@ -1,8 +1,16 @@
 from collections import OrderedDict
 from collections.abc import Sequence, Mapping
-from urllib.parse import urlparse
+from urllib.parse import urlparse, urljoin, urlsplit, urlunsplit
+from functools import lru_cache
+from itertools import islice
+import re
+import html
+import codecs
 import logging
 
+from lxml import etree
+from lxml.cssselect import CSSSelector, SelectorError
+
 logger = logging.getLogger('scrape')
 
 
@@ -33,13 +41,66 @@ def validate_text(url, text, config, key):
     return err_msg
 
 
-def apply_url_config(url, config):
-    try:
-        part_name = config['component']
-    except KeyError:
+# Query parameters which only track where a visitor came from, so urls which differ in them are the same page
+TRACKING_PARAMS = ('fbclid', 'gclid', 'dclid', 'msclkid', 'mc_cid', 'mc_eid')
+TRACKING_PARAM_PREFIXES = ('utm_',)
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+# Number of urls whose url config results are cached
+URL_CACHE_SIZE = 4096
+
+
+def canonicalize_url(url, trailing_slash=None):
+    """Return url in a canonical form, so that variants of the url of a page are crawled only once.
+
+    The scheme and host are lowercased, default ports, fragments and tracking parameters are removed,
+    and an empty path becomes /. If trailing_slash is True or False, a trailing slash is added to
+    or removed from the path (servers differ in which variant they treat as the page, so by default
+    the path is kept as it is).
+    """
+    parts = urlsplit(url)
+    scheme = parts.scheme.lower()
+    netloc = parts.netloc
+    if parts.hostname is not None:
+        netloc = parts.hostname
+        if ':' in netloc:
+            netloc = '[{}]'.format(netloc)
+        try:
+            port = parts.port
+        except ValueError:
+            port = None
+        if port is not None and port != DEFAULT_PORTS.get(scheme):
+            netloc += ':{}'.format(port)
+        userinfo = parts.netloc.rpartition('@')[0]
+        if userinfo:
+            netloc = userinfo + '@' + netloc
+    path = parts.path or '/'
+    if trailing_slash is True and not path.endswith('/'):
+        path += '/'
+    elif trailing_slash is False and path != '/':
+        path = path.rstrip('/') or '/'
+    query = parts.query
+    if query:
+        params = [param for param in query.split('&')
+            if not is_tracking_param(param.partition('=')[0])]
+        query = '&'.join(params)
+    return urlunsplit((scheme, netloc, path, query, ''))
+
+
+def is_tracking_param(name):
+    name = name.lower()
+    return name in TRACKING_PARAMS or name.startswith(TRACKING_PARAM_PREFIXES)
+
+
+def check_url_config(config):
+    if 'component' not in config:
         raise ConfigError("url subconfig does not contain 'component'")
+
+
+def apply_parsed_url_config(url_parts, config):
+    'Apply a url subconfig to url_parts, which is the result of urlparse'
+    check_url_config(config)
+    part_name = config['component']
     text = None
-    url_parts = urlparse(url)
     if part_name == 'path':
         path = url_parts.path
         if 'index' in config:
@@ -57,33 +118,367 @@ def apply_url_config(url, config):
     return text
 
 
-def apply_document_config(url, document, config, result=None):
+def apply_url_config(url, config):
+    return apply_parsed_url_config(urlparse(url), config)
+
+
+class UrlPlan(Mapping):
+    """The url config compiled for repeated use.
+
+    resolve applies every url subconfig to a url after parsing it once, and its results are cached,
+    since the same url is resolved when it is found on a page, when it is taken from the frontier
+    and when its page is scraped. A UrlPlan can be used wherever the url config mapping
+    it was compiled from is expected.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        for d in config.values():
+            check_url_config(d)
+        self.resolve = lru_cache(maxsize=URL_CACHE_SIZE)(self.resolve_uncached)
+
+    def __getitem__(self, key):
+        return self.config[key]
+
+    def __iter__(self):
+        return iter(self.config)
+
+    def __len__(self):
+        return len(self.config)
+
+    def __reduce__(self):
+        return (UrlPlan, (self.config,))
+
+    def resolve_uncached(self, url):
+        'Return a dict mapping each key of the url config to the value it takes from url'
+        url_parts = urlparse(url)
+        return {k: apply_parsed_url_config(url_parts, d) for k, d in self.config.items()}
+
+
+def compile_url_config(config):
+    if isinstance(config, UrlPlan):
+        return config
+    return UrlPlan(config)
+
+
+def url_to_id(url, config):
+    url_config = config['url']
+    if isinstance(url_config, UrlPlan):
+        return url_config.resolve(url).get('id')
+    return apply_url_config(url, url_config['id'])
+
+
+def get_edges(url, info, config, reverse=False):
+    """Yield (edge, id, url) for each crawl edge of a scraped page.
+
+    Urls are made absolute and canonical before their ids are taken from them.
+    """
+    empty_urls = ('', '/', '#', '/#')
+    if reverse:
+        edges = reversed(config['crawl'])
+    else:
+        edges = config['crawl']
+    for e in edges:
+        url2 = info.get(e)
+        if url2 is None or url2 in empty_urls:
+            continue
+        url2 = canonicalize_url(urljoin(url, url2), config.get('trailing_slash'))
+        yield (e, url_to_id(url2, config), url2)
+
+
+# Keys of a scrape config which select the values of a field, each by a different extractor
+EXTRACTORS = ('css', 'xpath', 'regex')
+# Byte order marks and the encodings which decode them (and leave them out of the text)
+BOMS = ((b'\xef\xbb\xbf', 'utf-8-sig'), (b'\xff\xfe', 'utf-16'), (b'\xfe\xff', 'utf-16'))
+# Browsers look for a charset declaration in the first 1024 bytes of a page.
+META_CHARSET_LIMIT = 1024
+META_CHARSET_RE = re.compile(rb'<meta[^>]+charset\s*=\s*["\']?\s*([A-Za-z0-9_.:-]+)', re.IGNORECASE)
+# Tokens of an XPath expression: literals, function calls (with the parenthesis, and the closing one if there
+# are no arguments), axes, attributes, numbers, . and .., / and //, names and single characters
+XPATH_TOKEN_RE = re.compile(r'''"[^"]*"|'[^']*'|[A-Za-z_][\w.-]*(?::[A-Za-z_][\w.-]*)?\s*\((?:\s*\))?|'''
+    r'''[A-Za-z_][\w.-]*\s*::|@[\w.:*-]*|\d+(?:\.\d*)?|\.\.?|//?|[A-Za-z_][\w.-]*(?::[A-Za-z_][\w.-]*)?|\S''')
+# Axes which select nodes which come before the context node in the document
+REVERSE_AXES = ('ancestor', 'ancestor-or-self', 'parent', 'preceding', 'preceding-sibling')
+# Functions without arguments whose value does not depend on what follows the context node
+STABLE_CALLS = ('position()', 'name()', 'local-name()', 'namespace-uri()', 'true()', 'false()')
+
+
+class DocumentPlan(Mapping):
+    """A document config compiled for repeated use.
+
+    CSS selectors are translated to XPath once, and fields which use the same selector
+    share a single evaluation per document. XPath expressions and regexes are compiled once.
+    A DocumentPlan can be used wherever the document config mapping it was compiled from is expected.
+
+    Regexes are matched against the raw page, so if no field uses css or xpath,
+    pages are scraped without being parsed (needs_document is False).
+
+    unstable_keys are the fields whose value in the start of a page can differ from their value in the whole page
+    (see is_prefix_stable), so pages can't be scraped before they have been read to the end.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.selectors = OrderedDict()
+        self.xpaths = OrderedDict()
+        self.regexes = OrderedDict()
+        self.paths = OrderedDict()  # key -> name of the extractor used for it, or None
+        for k, d in config.items():
+            extractors = [name for name in EXTRACTORS if d.get(name) is not None]
+            if len(extractors) > 1:
+                raise ConfigError('{} uses more than one of {}'.format(k, ', '.join(extractors)))
+            self.paths[k] = extractors[0] if extractors else None
+            css = d.get('css')
+            if css is not None and css not in self.selectors:
+                try:
+                    # The default translator matches the same elements as document.cssselect.
+                    self.selectors[css] = CSSSelector(css)
+                except SelectorError as e:
+                    raise ConfigError('invalid css selector for {}: {}'.format(k, css)) from e
+            xpath = d.get('xpath')
+            if xpath is not None and xpath not in self.xpaths:
+                try:
+                    self.xpaths[xpath] = etree.XPath(xpath)
+                except etree.XPathSyntaxError as e:
+                    raise ConfigError('invalid xpath for {}: {}'.format(k, xpath)) from e
+            regex = d.get('regex')
+            if regex is not None and regex not in self.regexes:
+                try:
+                    self.regexes[regex] = re.compile(regex)
+                except re.error as e:
+                    raise ConfigError('invalid regex for {}: {}'.format(k, regex)) from e
+        self.needs_document = any(path in ('css', 'xpath') for path in self.paths.values())
+        self.unstable_keys = [k for k, d in config.items() if not self.is_prefix_stable(k, d)]
+
+    def is_prefix_stable(self, key, d):
+        'Return whether the value of a field, once it is found in the start of a page, is its value in the whole page'
+        path = self.paths[key]
+        if d.get('index', 0) < 0:
+            # negative indices count from the end
+            return path is None
+        if path == 'css':
+            return is_prefix_stable(self.selectors[d['css']].path)
+        if path == 'xpath':
+            return is_prefix_stable(d['xpath'])
+        return True
+
+    def __getitem__(self, key):
+        return self.config[key]
+
+    def __iter__(self):
+        return iter(self.config)
+
+    def __len__(self):
+        return len(self.config)
+
+    def select(self, document):
+        'Return a dict mapping each distinct css selector to the list of tags it matches'
+        return {css: selector(document) for css, selector in self.selectors.items()}
+
+    def select_xpath(self, document):
+        'Return a dict mapping each distinct xpath to the list of tags or strings it evaluates to'
+        matches = {}
+        for xpath, compiled in self.xpaths.items():
+            result = compiled(document)
+            if not isinstance(result, list):
+                # numbers and booleans are converted to strings, like strings found in the page
+                result = [format_xpath_scalar(result)]
+            matches[xpath] = result
+        return matches
+
+    def match(self, text, regex, index=0):
+        'Return the index-th match of regex in text (the decoded page), or None'
+        matches = self.regexes[regex].finditer(text)
+        if index < 0:
+            matches = list(matches)
+        else:
+            matches = islice(matches, index, index + 1)
+        try:
+            return list(matches)[index if index < 0 else 0]
+        except IndexError:
+            return None
+
+    def describe(self):
+        'Return a description of the extractor used for each field'
+        text = ', '.join('{}: {}'.format(k, path or 'none') for k, path in self.paths.items())
+        if not self.needs_document:
+            text += ' (pages are not parsed)'
+        return text
+
+
+def is_prefix_stable(xpath):
+    """Return whether xpath selects the same first nodes in the start of a document as in the whole document.
+
+    A document is parsed in order, so this holds if whether a node is selected depends only on the node
+    and on what comes before it. Predicates may only use attributes and the axes which look back
+    (like count(preceding-sibling::*), which css selectors like :first-child use), and the path may only
+    go forward. Anything else (like last(), following-sibling::* in a predicate, the text of a node
+    or whether it has children) is assumed to depend on what follows.
+    """
+    depth = 0
+    after_axis = False
+    for token in XPATH_TOKEN_RE.findall(xpath):
+        if token == '[':
+            depth += 1
+        elif token == ']':
+            depth -= 1
+        if token.startswith('last(') or token.startswith('id('):
+            return False
+        if token.endswith('::'):
+            axis = token[:-2].strip()
+            if (axis in REVERSE_AXES) != (depth > 0) and axis not in ('self', 'attribute'):
+                return False
+            after_axis = True
+            continue
+        if depth == 0:
+            if token == '..':
+                return False
+        elif after_axis or token[0] in '"\'@' or token[0].isdigit() or token in '[]()=!<>+-|,' \
+                or token in ('and', 'or', 'div', 'mod') or token in STABLE_CALLS:
+            pass
+        elif token.endswith('(') and token[:-1].strip() != 'id':
+            # a function with arguments, which are checked on their own
+            pass
+        else:
+            # a child step, the context node or its text, a path or a function of the text
+            return False
+        after_axis = False
+    return True
+
+
+def format_xpath_scalar(value):
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+def get_match_text(match):
+    'Return the text captured by a regex match: the group named value, else the first group, else all of it'
+    if 'value' in match.re.groupindex:
+        raw = match.group('value')
+    elif match.re.groups:
+        raw = match.group(1)
+    else:
+        raw = match.group(0)
+    if raw is None:
+        return None
+    # Values in HTML (like urls in attributes) can contain character references.
+    return html.unescape(raw)
+
+
+def get_page_encoding(data, charset=None):
+    """Return the encoding of the raw page data, or None if it is not declared.
+
+    A byte order mark comes first, then charset (from the Content-Type header),
+    then a charset declared by a meta tag near the start of the page (which lxml also uses).
+    """
+    for bom, encoding in BOMS:
+        if data.startswith(bom):
+            return encoding
+    if charset:
+        return charset
+    m = META_CHARSET_RE.search(data[:META_CHARSET_LIMIT])
+    if m is not None:
+        return m.group(1).decode('ascii')
+    return None
+
+
+def get_page_decoder(encoding):
+    'Return an incremental decoder for a declared encoding, or a strict UTF-8 decoder if it is None or unknown'
+    if encoding is not None:
+        try:
+            return codecs.getincrementaldecoder(encoding)(errors='replace')
+        except LookupError:
+            logger.warning('Unknown encoding {}; decoding page as UTF-8'.format(encoding))
+    return codecs.getincrementaldecoder('utf-8')()
+
+
+def decode_page(data, charset=None, final=True):
+    """Return the raw page data as text, decoded with its declared encoding.
+
+    Pages without a declared encoding are decoded as UTF-8 if they are valid UTF-8, else as Latin-1.
+    If final is False, data is only the start of the page, and a character cut off at its end is left out.
+    """
+    try:
+        return get_page_decoder(get_page_encoding(data, charset)).decode(data, final)
+    except UnicodeDecodeError:
+        return data.decode('latin-1')
+
+
+def compile_document_config(config):
+    if isinstance(config, DocumentPlan):
+        return config
+    return DocumentPlan(config)
+
+
+def scrape_page(url, data, config, result=None, document=None, charset=None):
+    """Apply the document config to the raw page data and return the result.
+
+    The page is parsed only if a field of config needs the document tree and document is not given.
+    charset is the one given by the Content-Type header of the page, if it is known.
+    """
+    plan = compile_document_config(config)
+    if document is None and plan.needs_document:
+        document = etree.HTML(data)
+    return apply_document_config(url, document, plan, result, data=data, charset=charset)
+
+
+def apply_document_config(url, document, config, result=None, data=None, charset=None):
+    """Apply the document config to document and return the result.
+
+    data is the raw page, which is needed by fields which use regex (see decode_page for charset);
+    if it is not given, it is serialized from document.
+    """
     if result is None:
         result = OrderedDict()
+    plan = compile_document_config(config)
+    matches = plan.select(document) if plan.selectors else {}
+    xpath_matches = plan.select_xpath(document) if plan.xpaths else {}
+    page_text = None
+    if plan.regexes:
+        if data is not None:
+            page_text = decode_page(data, charset)
+        elif document is not None:
+            page_text = etree.tostring(document, encoding='unicode')
+        else:
+            page_text = ''
     scrape_errors = OrderedDict()
-    for k, d in config.items():
+    for k, d in plan.items():
         text = None
+        index = d.get('index', 0)
+        path = plan.paths[k]
 
-        # get tags
-        if 'css' in d:
-            tags = document.cssselect(d['css'])
+        if path == 'regex':
+            match = plan.match(page_text, d['regex'], index)
+            if match is not None:
+                text = get_match_text(match)
         else:
-            tags = []
+            # get tags
+            if path == 'css':
+                tags = matches[d['css']]
+            elif path == 'xpath':
+                tags = xpath_matches[d['xpath']]
+            else:
+                tags = []
 
-        # get tag
-        index = d.get('index', 0)
-        try:
-            tag = tags[index]
-        except IndexError:
-            tag = None
+            # get tag
+            try:
+                tag = tags[index]
+            except IndexError:
+                tag = None
 
-        # get text
-        if tag is not None:
-            attr = d.get('attr')
-            if attr is None:
-                text = ''.join(tag.itertext())
-            else:
-                text = tag.attrib.get(attr)
+            # get text
+            if isinstance(tag, str):
+                # an xpath which selects attributes or text gives strings
+                text = str(tag)
+            elif tag is not None:
+                attr = d.get('attr')
+                if attr is None:
+                    text = ''.join(tag.itertext())
+                else:
+                    text = tag.attrib.get(attr)
 
         # url process
         if text is not None and d.get('url') is not None:
@@ -99,3 +494,155 @@ def apply_document_config(url, document, config, result=None):
     if scrape_errors:
         result['_scrape_errors'] = scrape_errors
     return result
+
+
+class StreamingScraper:
+    """Incrementally parses an HTML document fed in chunks.
+
+    feed returns True once every field of the document config has been found,
+    so that the rest of the document need not be downloaded or parsed.
+    A field which uses the text of a tag is found only after the tag has ended,
+    and a field which uses a regex only once more of the page has been read after its match.
+    If no field needs the document tree, the page is not parsed at all.
+    If a field can only be found in the whole page (see DocumentPlan.unstable_keys), feed never returns True.
+
+    Fields which have been found are not looked for again, regexes are matched from where they last stopped,
+    and selectors are evaluated again only once the page has grown by SELECT_GROWTH since they last were,
+    so that the time spent on a page stays proportional to its size.
+    """
+
+    SELECT_GROWTH = 0.25
+
+    def __init__(self, config):
+        self.plan = compile_document_config(config)
+        self.stream = not self.plan.unstable_keys
+        self.reset()
+
+    def reset(self, charset=None):
+        'Start a new document, whose charset (from the Content-Type header) is used to decode it for regex fields'
+        self.charset = charset
+        self.parser = etree.HTMLPullParser(events=('start',)) if self.plan.needs_document else None
+        self.root = None
+        self.chunks = [] if self.plan.regexes and self.stream else None
+        self.decoder = None
+        self.text = ''
+        self.size = 0
+        self.selected_size = 0
+        self.found = set()
+        self.tags = {}  # key -> tag selected for it, which has not ended yet
+        self.match_state = {}  # key -> (number of matches which have been counted, start of the last one)
+
+    def feed(self, chunk):
+        self.size += len(chunk)
+        if self.chunks is not None:
+            self.chunks.append(chunk)
+            self.decode(chunk)
+        if self.parser is not None:
+            self.parser.feed(chunk)
+            if self.root is None:
+                for event, element in self.parser.read_events():
+                    self.root = element.getroottree().getroot()
+                    break
+            else:
+                # events are not needed once the root is known
+                for event in self.parser.read_events():
+                    pass
+            if self.root is None:
+                return False
+        return self.stream and self.is_resolved()
+
+    def decode(self, chunk):
+        'Add chunk to the decoded text, once enough of the page has been read to know its encoding'
+        if self.decoder is None:
+            data = b''.join(self.chunks)
+            if len(data) < META_CHARSET_LIMIT:
+                return
+            self.decoder = get_page_decoder(get_page_encoding(data, self.charset))
+            chunk = data
+        try:
+            self.text += self.decoder.decode(chunk)
+        except UnicodeDecodeError:
+            # like decode_page, a page which is not UTF-8 is decoded as Latin-1, and regexes start again
+            self.decoder = codecs.getincrementaldecoder('latin-1')()
+            self.text = self.decoder.decode(b''.join(self.chunks))
+            self.match_state = {}
+            self.found = {k for k in self.found if self.plan.paths[k] != 'regex'}
+
+    def is_resolved(self):
+        select = self.size >= self.selected_size * (1 + self.SELECT_GROWTH)
+        matches = {}
+        for k, d in self.plan.items():
+            path = self.plan.paths[k]
+            if path is None or k in self.found:
+                continue
+            if path == 'regex':
+                found = self.find_match(k, d)
+            else:
+                found = self.find_tag(k, d, path, select, matches)
+            if not found:
+                if matches:
+                    self.selected_size = self.size
+                return False
+            self.found.add(k)
+        return True
+
+    def find_match(self, k, d):
+        'Return whether the regex of field k has matched, counting the matches in the text decoded since last time'
+        if self.decoder is None:
+            return False
+        count, start = self.match_state.get(k, (0, 0))
+        matches = self.plan.regexes[d['regex']].finditer(self.text, start)
+        if count:
+            # the last match which was counted
+            next(matches, None)
+        for match in matches:
+            # a match which reaches the end of what has been read might grow with more data
+            if match.end() >= len(self.text):
+                break
+            count += 1
+            start = match.start()
+            if count > d.get('index', 0):
+                return True
+        self.match_state[k] = (count, start)
+        return False
+
+    def find_tag(self, k, d, path, select, matches):
+        'Return whether the tag of field k has been found (and has ended, if its text is used)'
+        tag = self.tags.get(k)
+        if tag is None:
+            if not select:
+                return False
+            expr = d[path]
+            if expr not in matches:
+                compiled = self.plan.selectors[expr] if path == 'css' else self.plan.xpaths[expr]
+                matches[expr] = compiled(self.root)
+            tags = matches[expr]
+            index = d.get('index', 0)
+            if not isinstance(tags, list) or index >= len(tags):
+                # a number or string computed by an xpath may change as the document grows
+                return False
+            tag = tags[index]
+            if isinstance(tag, str):
+                # text nodes may still grow, so the tag they belong to must have ended
+                tag = tag.getparent() if hasattr(tag, 'getparent') else None
+                if tag is None:
+                    return False
+            if d.get('attr') is not None and path == 'css':
+                return True
+            self.tags[k] = tag
+        return has_ended(tag)
+
+    def close(self):
+        'Return the root of the parsed document (None if the page was not parsed)'
+        if self.parser is None:
+            return None
+        return self.parser.close()
+
+
+def has_ended(element):
+    'Return whether the parser has moved past the end of element'
+    while element is not None:
+        if element.getnext() is not None:
+            return True
+        element = element.getparent()
+    return False
@@ -0,0 +1,107 @@
+"""
+Crawling a comic in several segments at once.
+
+A chain of pages linked by prev and next can only be crawled one page after another from a single
+starting point. With several seed urls (or an id range, for comics whose ids are numbers in their urls),
+the chain is crawled from every seed at once, and each segment stops where it runs into pages
+which another segment has already reached.
+
+Pages get serial numbers in the order in which they are crawled, which interleaves the segments,
+so when the crawl is complete they are stitched together: serial numbers are assigned again
+in the order in which a crawl from the first seed alone would have reached the pages.
+Pages are rendered only after that, since their serial numbers are shown in them.
+"""
+
+import logging
+
+import theme
+from prefetch import get_numeric_id_index, replace_id
+
+logger = logging.getLogger('segments')
+
+# Info is saved in batches of this many objects while stitching.
+STITCH_BATCH_SIZE = 500
+
+
+def get_id_range_seeds(config, url, start, stop, segments):
+    """Return the urls of segments evenly spaced seeds with ids in range(start, stop).
+
+    Seed urls are made by replacing the id in url, so ids must be numbers in the url path.
+    """
+    index = get_numeric_id_index(config)
+    if index is None:
+        raise ValueError('ids are not taken from a path component of urls, so seeds cannot be made from ids')
+    if stop <= start:
+        raise ValueError('the id range {}..{} is empty'.format(start, stop))
+    segments = max(1, min(segments, stop - start))
+    seeds = []
+    for i in range(segments):
+        seed = replace_id(url, index, str(start + (stop - start) * i // segments))
+        if seed is None:
+            raise ValueError('could not put an id into {}'.format(url))
+        seeds.append(seed)
+    return seeds
+
+
+def get_stitched_order(entries, first_sno):
+    """Return the ids of pages with serial numbers from first_sno onwards, in the order
+    in which a crawl of just those pages, starting at the page with the lowest serial number, reaches them.
+
+    entries maps ids to index entries (with _sno and _adj). The frontier is simulated like the crawler's:
+    adjacent ids (in the order of _adj) are pushed on a stack, and the last one is taken first.
+    Pages which can't be reached that way follow, starting with the lowest serial number left.
+    """
+    segment_entries = {id: entry for id, entry in entries.items() if entry.get('_sno', 0) >= first_sno}
+    by_sno = sorted(segment_entries, key=lambda id: segment_entries[id]['_sno'])
+    order = []
+    seen = set()
+    for start_id in by_sno:
+        if start_id in seen:
+            continue
+        pending = [start_id]
+        while pending:
+            id = pending.pop()
+            if id in seen:
+                continue
+            seen.add(id)
+            order.append(id)
+            for id2 in segment_entries[id].get('_adj', {}).values():
+                if id2 is not None and id2 in segment_entries and id2 not in seen:
+                    pending.append(id2)
+    return order
+
+
+def stitch(out_dir, store, first_sno, page_template=None, render_manifest=None):
+    """Assign serial numbers from first_sno onwards again, in the order of a crawl from the first seed.
+
+    Pages whose serial number changes are saved. If page_template is given, all stitched pages
+    are rendered, since the crawl doesn't render pages while serial numbers can still change.
+    Return the info of the page which gets the highest serial number, or None if there are no pages.
+    """
+    entries = theme.load_index_entries(out_dir, store)
+    order = get_stitched_order(entries, first_sno)
+    changed = []
+    changed_count = 0
+    last_info = None
+    for i, id in enumerate(order):
+        sno = first_sno + i
+        is_last = i == len(order) - 1
+        if entries[id]['_sno'] == sno and not is_last and page_template is None:
+            continue
+        info = store.load(id)
+        if is_last:
+            last_info = info
+        if info['_sno'] != sno:
+            info['_sno'] = sno
+            changed.append(info)
+            changed_count += 1
+            if len(changed) >= STITCH_BATCH_SIZE:
+                store.save_many(changed)
+                changed = []
+        if page_template is not None:
+            theme.render_page(page_template, info, out_dir, force=render_manifest is None,
+                manifest=render_manifest)
+    store.save_many(changed)
+    logger.info('Stitched segments of {} pages; {} of them got new serial numbers'.format(
+        len(order), changed_count))
+    return last_info
@@ -0,0 +1,375 @@
+#!/usr/bin/env python3
+
+"""
+Packaging of the generated site for serving and syncing.
+
+compress: writes precompressed siblings (<file>.gz, and <file>.br if the brotli module is installed)
+  of text files in out_dir/site, which servers like nginx (gzip_static) can send as they are.
+  out_dir/sitepack.json records the size, modification time and hash of each compressed file,
+  so only files whose content has changed are compressed again.
+pack: writes the whole site to a single zip file. Text files are deflated (so a member is a gzip body
+  without its header and trailer), other files (like images) are stored as they are.
+serve: serves a zip written by pack over HTTP. Members are sent from the zip with sendfile,
+  deflated members as gzip to clients which accept it, so the site is never unpacked.
+
+With --minify, HTML is minified in the compressed siblings and the zip (files in out_dir/site are left as they are).
+"""
+
+import os
+from os.path import join as pjoin
+import re
+import sys
+import json
+import gzip
+import time
+import zlib
+import struct
+import hashlib
+import logging
+import mimetypes
+import threading
+import zipfile
+from urllib.parse import unquote, urlsplit
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+from util import open_atomic
+
+logger = logging.getLogger('sitepack')
+
+MANIFEST_FNAME = 'sitepack.json'
+TEXT_EXTENSIONS = ('.html', '.htm', '.css', '.js', '.json', '.svg', '.txt', '.xml')
+COMPRESSED_EXTENSIONS = ('.gz', '.br')
+# Files which are still being written, like resources which are being downloaded (see downloads.py)
+PARTIAL_EXTENSIONS = ('.tmp', '.part', '.part.json')
+# Smaller files are not worth compressing.
+MIN_COMPRESS_SIZE = 256
+# Zip members get this timestamp, so that the same site always gives the same zip.
+ZIP_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+
+PRESERVE_RE = re.compile(r'(<(pre|textarea|script|style)\b.*?</\2\s*>)', re.IGNORECASE | re.DOTALL)
+COMMENT_RE = re.compile(r'<!--(?!\[if).*?-->', re.DOTALL)
+SPACE_RE = re.compile(r'\s+')
+
+
+def minify_html(text):
+    """Return text with comments removed and runs of whitespace collapsed into a single space.
+
+    The contents of pre, textarea, script and style elements are kept as they are.
+    """
+    parts = PRESERVE_RE.split(text)
+    result = []
+    # split gives [text, element, tag name, text, element, tag name, ...]
+    for i in range(0, len(parts), 3):
+        result.append(SPACE_RE.sub(' ', COMMENT_RE.sub('', parts[i])))
+        if i + 1 < len(parts):
+            result.append(parts[i + 1])
+    return ''.join(result).strip()
+
+
+def is_text(fpath):
+    return fpath.lower().endswith(TEXT_EXTENSIONS)
+
+
+def get_site_files(site_dir):
+    'Yield paths (relative to site_dir, with / as separator) of files in site_dir, except compressed siblings and partial files'
+    for dirpath, dirnames, fnames in os.walk(site_dir):
+        dirnames.sort()
+        for fname in sorted(fnames):
+            if fname.endswith(COMPRESSED_EXTENSIONS) or fname.endswith(PARTIAL_EXTENSIONS):
+                continue
+            yield os.path.relpath(pjoin(dirpath, fname), site_dir).replace(os.sep, '/')
+
+
+def read_for_packing(fpath, minify=False):
+    'Return the content of fpath, minified if it is HTML and minify is True'
+    with open(fpath, 'rb') as fobj:
+        data = fobj.read()
+    if minify and fpath.lower().endswith(('.html', '.htm')):
+        try:
+            data = minify_html(data.decode('utf-8')).encode('utf-8')
+        except UnicodeDecodeError:
+            pass
+    return data
+
+
+def write_sibling(fpath, data):
+    with open_atomic(fpath, 'wb') as fobj:
+        fobj.write(data)
+
+
+def remove_siblings(fpath, extensions=COMPRESSED_EXTENSIONS):
+    for ext in extensions:
+        try:
+            os.remove(fpath + ext)
+        except FileNotFoundError:
+            pass
+
+
+def compress_site(out_dir, use_brotli=False, minify=False):
+    """Write precompressed siblings of text files in out_dir/site whose content has changed.
+
+    Return the numbers of files which were compressed and which were up to date.
+    """
+    site_dir = pjoin(out_dir, 'site')
+    manifest_path = pjoin(out_dir, MANIFEST_FNAME)
+    options = {'brotli': use_brotli, 'minify': minify}
+    try:
+        with open(manifest_path) as fobj:
+            manifest = json.load(fobj)
+    except (FileNotFoundError, ValueError):
+        manifest = None
+    if manifest is None or manifest.get('options') != options:
+        manifest = {'options': options, 'files': {}}
+    old_files = manifest['files']
+    extensions = ('.gz', '.br') if use_brotli else ('.gz',)
+
+    files = {}
+    compressed, unchanged = 0, 0
+    for rel_path in get_site_files(site_dir):
+        if not is_text(rel_path):
+            continue
+        fpath = pjoin(site_dir, *rel_path.split('/'))
+        st = os.stat(fpath)
+        stamp = [st.st_size, st.st_mtime_ns]
+        entry = old_files.get(rel_path)
+        siblings_exist = entry is None or all(os.path.isfile(fpath + ext) for ext in entry['siblings'])
+        if entry is not None and entry['stamp'] == stamp and siblings_exist:
+            files[rel_path] = entry
+            unchanged += 1
+            continue
+        data = read_for_packing(fpath, minify)
+        hash = hashlib.sha1(data).hexdigest()
+        if entry is not None and entry['hash'] == hash and siblings_exist:
+            # The file was written again (like by render.py --force) with the same content.
+            files[rel_path] = dict(entry, stamp=stamp)
+            unchanged += 1
+            continue
+        siblings = []
+        if len(data) >= MIN_COMPRESS_SIZE:
+            # mtime=0 makes the output depend only on the content, which helps syncing.
+            candidates = {'.gz': gzip.compress(data, compresslevel=9, mtime=0)}
+            if use_brotli:
+                candidates['.br'] = brotli.compress(data)
+            for ext, compressed_data in candidates.items():
+                if len(compressed_data) < len(data):
+                    write_sibling(fpath + ext, compressed_data)
+                    siblings.append(ext)
+        remove_siblings(fpath, [ext for ext in extensions if ext not in siblings])
+        files[rel_path] = {'stamp': stamp, 'hash': hash, 'siblings': siblings}
+        compressed += 1
+
+    for rel_path in set(old_files) - set(files):
+        # The file was deleted, so its siblings are stale.
+        remove_siblings(pjoin(site_dir, *rel_path.split('/')))
+    manifest['files'] = files
+    with open_atomic(manifest_path) as fobj:
+        json.dump(manifest, fobj)
+    return (compressed, unchanged)
+
+
+def pack_site(out_dir, zip_path, minify=False):
+    'Write all files in out_dir/site to a zip at zip_path and return the number of files'
+    site_dir = pjoin(out_dir, 'site')
+    count = 0
+    with open_atomic(zip_path, 'wb') as fobj, zipfile.ZipFile(fobj, 'w') as zfile:
+        for rel_path in get_site_files(site_dir):
+            fpath = pjoin(site_dir, *rel_path.split('/'))
+            zinfo = zipfile.ZipInfo(rel_path, ZIP_DATE_TIME)
+            zinfo.external_attr = 0o644 << 16
+            if is_text(rel_path):
+                zinfo.compress_type = zipfile.ZIP_DEFLATED
+                zfile.writestr(zinfo, read_for_packing(fpath, minify), compresslevel=9)
+            else:
+                zinfo.compress_type = zipfile.ZIP_STORED
+                # Large files (like videos) are copied in chunks.
+                with open(fpath, 'rb') as source, zfile.open(zinfo, 'w', force_zip64=True) as dest:
+                    while True:
+                        chunk = source.read(1024 * 1024)
+                        if not chunk:
+                            break
+                        dest.write(chunk)
+            count += 1
+    return count
+
+
+class ZipSite:
+    'Members of a zip written by pack_site, located for sending them straight from the file'
+
+    # signature, version, flags, method, time, date, crc, compressed size, size, name length, extra length
+    LOCAL_HEADER = struct.Struct('<IHHHHHIIIHH')
+
+    def __init__(self, zip_path):
+        self.fobj = open(zip_path, 'rb')
+        self.fd = self.fobj.fileno()
+        with zipfile.ZipFile(zip_path) as zfile:
+            self.members = {zinfo.filename: zinfo for zinfo in zfile.infolist() if not zinfo.is_dir()}
+        self.offsets = {}  # name -> offset of the data of the member
+        self.lock = threading.Lock()
+
+    def get(self, name):
+        'Return (ZipInfo, offset of data) of the member with the given name, or None'
+        zinfo = self.members.get(name)
+        if zinfo is None:
+            return None
+        with self.lock:
+            offset = self.offsets.get(name)
+        if offset is None:
+            # The extra field of the local header can differ from the one in the central directory.
+            header = os.pread(self.fd, self.LOCAL_HEADER.size, zinfo.header_offset)
+            fields = self.LOCAL_HEADER.unpack(header)
+            offset = zinfo.header_offset + self.LOCAL_HEADER.size + fields[9] + fields[10]
+            with self.lock:
+                self.offsets[name] = offset
+        return (zinfo, offset)
+
+    def close(self):
+        self.fobj.close()
+
+
+def get_gzip_header():
+    # magic, deflate, no flags, no mtime, no extra flags, unknown OS
+    return b'\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff'
+
+
+def send_file_range(sock, fd, offset, count):
+    'Send count bytes of fd from offset over sock, without copying them through Python if possible'
+    if hasattr(os, 'sendfile'):
+        while count > 0:
+            sent = os.sendfile(sock.fileno(), fd, offset, count)
+            if sent == 0:
+                raise ConnectionError('connection closed while sending')
+            offset += sent
+            count -= sent
+        return
+    while count > 0:
+        chunk = os.pread(fd, min(count, 1024 * 1024), offset)
+        sock.sendall(chunk)
+        offset += len(chunk)
+        count -= len(chunk)
+
+
+class ZipSiteHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server_version = 'webcomic-offliner'
+    site = None  # set on a subclass by serve
+
+    def log_message(self, format, *args):
+        logger.debug('%s - %s', self.address_string(), format % args)
+
+    def get_member_name(self):
+        path = unquote(urlsplit(self.path).path).lstrip('/')
+        if path == '' or path.endswith('/'):
+            path += 'index.html'
+        return path
+
+    def do_HEAD(self):
+        self.send_member(head=True)
+
+    def do_GET(self):
+        self.send_member(head=False)
+
+    def send_member(self, head):
+        found = self.site.get(self.get_member_name())
+        if found is None:
+            self.send_error(404)
+            return
+        zinfo, offset = found
+        etag = '"{:08x}-{:x}"'.format(zinfo.CRC, zinfo.file_size)
+        content_type = mimetypes.guess_type(zinfo.filename)[0] or 'application/octet-stream'
+        if content_type.startswith('text/') or content_type in ('application/javascript', 'application/json'):
+            content_type += '; charset=utf-8'
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        accepts_gzip = 'gzip' in (self.headers.get('Accept-Encoding') or '')
+        deflated = zinfo.compress_type == zipfile.ZIP_DEFLATED
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('ETag', etag)
+        if deflated:
+            self.send_header('Vary', 'Accept-Encoding')
+        if deflated and accepts_gzip:
+            # A deflated member is a gzip body; the zip already has the CRC and size for its trailer.
+            trailer = struct.pack('<II', zinfo.CRC, zinfo.file_size & 0xffffffff)
+            self.send_header('Content-Encoding', 'gzip')
+            self.send_header('Content-Length', str(len(get_gzip_header()) + zinfo.compress_size + len(trailer)))
+            self.end_headers()
+            if not head:
+                self.wfile.write(get_gzip_header())
+                send_file_range(self.connection, self.site.fd, offset, zinfo.compress_size)
+                self.wfile.write(trailer)
+        elif deflated:
+            self.send_header('Content-Length', str(zinfo.file_size))
+            self.end_headers()
+            if not head:
+                data = os.pread(self.site.fd, zinfo.compress_size, offset)
+                self.wfile.write(zlib.decompress(data, -zlib.MAX_WBITS))
+        else:
+            self.send_header('Content-Length', str(zinfo.file_size))
+            self.end_headers()
+            if not head:
+                send_file_range(self.connection, self.site.fd, offset, zinfo.file_size)
+
+
+def serve(zip_path, host='127.0.0.1', port=8000):
+    site = ZipSite(zip_path)
+    handler = type('Handler', (ZipSiteHandler,), {'site': site})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    logger.info('Serving {} files from {} at http://{}:{}/'.format(
+        len(site.members), zip_path, host, server.server_address[1]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        site.close()
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='Package the generated site of a project')
+    parser.add_argument('command', choices=('compress', 'pack', 'serve'),
+        help='compress: write .gz (and .br) siblings of changed text files in out_dir/site;'
+            ' pack: write out_dir/site to a zip;'
+            ' serve: serve a zip written by pack over HTTP')
+    parser.add_argument('path', help='Output directory of project (for compress and pack) or zip file (for serve)')
+    parser.add_argument('--output', help='path of the zip written by pack (default: out_dir/site.zip)')
+    parser.add_argument('--minify', action='store_true', default=False,
+        help='minify HTML in compressed siblings and in the zip')
+    parser.add_argument('--brotli', action='store_true', default=False,
+        help='also write .br siblings (needs the brotli module)')
+    parser.add_argument('--host', default='127.0.0.1', help='address at which to serve')
+    parser.add_argument('--port', type=int, default=8000, help='port at which to serve')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+
+    if args.brotli and brotli is None:
+        parser.error('--brotli needs the brotli module (pip install brotli)')
+    start_time = time.perf_counter()
+    if args.command == 'compress':
+        compressed, unchanged = compress_site(args.path, args.brotli, args.minify)
+        logger.info('Compressed {} files; {} were up to date'.format(compressed, unchanged))
+    elif args.command == 'pack':
+        zip_path = args.output or pjoin(args.path, 'site.zip')
+        count = pack_site(args.path, zip_path, args.minify)
+        logger.info('Packed {} files into {} ({} bytes)'.format(count, zip_path, os.path.getsize(zip_path)))
+    else:
+        serve(args.path, args.host, args.port)
+        return 0
+    logger.info('Done in {:.1f} seconds'.format(time.perf_counter() - start_time))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+
+"""
+Storage for info objects.
+
+Info objects are stored either as one JSON file per id in out_dir/info
+or in a single SQLite database at out_dir/info.db.
+"""
+
+import os
+from os.path import join as pjoin
+import json
+import time
+import sqlite3
+import threading
+import logging
+from collections import OrderedDict
+
+import metrics
+from util import open_atomic
+
+logger = logging.getLogger('store')
+
+SQLITE_FNAME = 'info.db'
+STORE_KINDS = ('json', 'sqlite')
+# Info objects are copied between stores in batches of this many objects.
+COPY_BATCH_SIZE = 500
+
+
+class JsonInfoStore:
+    'Stores each info object at out_dir/info/<id>.json'
+
+    kind = 'json'
+
+    def __init__(self, out_dir):
+        self.info_dir = pjoin(out_dir, 'info')
+        os.makedirs(self.info_dir, exist_ok=True)
+
+    def get_path(self, id):
+        return pjoin(self.info_dir, id + '.json')
+
+    def exists(self, id):
+        return os.path.isfile(self.get_path(id))
+
+    def load(self, id):
+        'Return the info object with the given id or None if it does not exist'
+        try:
+            with open(self.get_path(id)) as fobj:
+                return json.load(fobj, object_pairs_hook=OrderedDict)
+        except FileNotFoundError:
+            return None
+
+    def save(self, info):
+        # Written to a temporary file first, so that a crash never leaves a truncated info file.
+        with metrics.timer('info_write'), open_atomic(self.get_path(info['id'])) as fobj:
+            json.dump(info, fobj, indent=4)
+
+    def save_many(self, infos):
+        for info in infos:
+            self.save(info)
+
+    def delete(self, id):
+        try:
+            os.remove(self.get_path(id))
+        except FileNotFoundError:
+            pass
+
+    def ids(self):
+        return [fname[:-len('.json')] for fname in os.listdir(self.info_dir) if fname.endswith('.json')]
+
+    def stamps(self):
+        'Return a dict mapping each id to a value which changes whenever its info changes'
+        stamps = {}
+        with os.scandir(self.info_dir) as it:
+            for entry in it:
+                if entry.name.endswith('.json'):
+                    stat = entry.stat()
+                    stamps[entry.name[:-len('.json')]] = '{}-{}'.format(stat.st_mtime_ns, stat.st_size)
+        return stamps
+
+    def __iter__(self):
+        for id in self.ids():
+            info = self.load(id)
+            if info is not None:
+                yield info
+
+    def __len__(self):
+        return len(self.ids())
+
+    def close(self):
+        pass
+
+
+class SqliteInfoStore:
+    """Stores all info objects in out_dir/info.db.
+
+    Crawl state (_sno and _adj) is kept in its own columns next to the full info object,
+    along with the times at which the row was created and last updated.
+    """
+
+    kind = 'sqlite'
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS info (
+            id TEXT PRIMARY KEY,
+            sno INTEGER,
+            adj TEXT,
+            created REAL NOT NULL,
+            updated REAL NOT NULL,
+            data TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS info_sno ON info (sno);
+    '''
+
+    def __init__(self, out_dir):
+        self.path = pjoin(out_dir, SQLITE_FNAME)
+        # The connection is shared by crawler threads, so access is serialized using self.lock.
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock:
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('PRAGMA synchronous=NORMAL')
+            self.conn.executescript(self.SCHEMA)
+            self.conn.commit()
+
+    def exists(self, id):
+        with self.lock:
+            row = self.conn.execute('SELECT 1 FROM info WHERE id = ?', (id,)).fetchone()
+        return row is not None
+
+    def load(self, id):
+        with self.lock:
+            row = self.conn.execute('SELECT data FROM info WHERE id = ?', (id,)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0], object_pairs_hook=OrderedDict)
+
+    def save(self, info):
+        self.save_many([info])
+
+    def save_many(self, infos):
+        'Save infos in a single transaction'
+        rows = []
+        for info in infos:
+            adj = info.get('_adj')
+            rows.append((info['id'], info.get('_sno'), None if adj is None else json.dumps(adj),
+                time.time(), json.dumps(info)))
+        with metrics.timer('info_write'), self.lock:
+            self.conn.executemany('''INSERT INTO info (id, sno, adj, created, updated, data)
+                VALUES (?1, ?2, ?3, ?4, ?4, ?5)
+                ON CONFLICT (id) DO UPDATE SET sno = ?2, adj = ?3, updated = ?4, data = ?5''', rows)
+            self.conn.commit()
+
+    def delete(self, id):
+        with self.lock:
+            self.conn.execute('DELETE FROM info WHERE id = ?', (id,))
+            self.conn.commit()
+
+    def ids(self):
+        with self.lock:
+            return [row[0] for row in self.conn.execute('SELECT id FROM info')]
+
+    def stamps(self):
+        with self.lock:
+            return {id: repr(updated) for id, updated in self.conn.execute('SELECT id, updated FROM info')}
+
+    def __iter__(self):
+        with self.lock:
+            rows = self.conn.execute('SELECT data FROM info ORDER BY sno').fetchall()
+        for row in rows:
+            yield json.loads(row[0], object_pairs_hook=OrderedDict)
+
+    def __len__(self):
+        with self.lock:
+            return self.conn.execute('SELECT COUNT(*) FROM info').fetchone()[0]
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+def open_store(out_dir, kind=None):
+    """Open the info store of a project.
+
+    If kind is None, the SQLite store is used if out_dir/info.db exists,
+    otherwise the JSON store is used.
+    """
+    if kind is None:
+        kind = 'sqlite' if os.path.isfile(pjoin(out_dir, SQLITE_FNAME)) else 'json'
+    if kind == 'sqlite':
+        return SqliteInfoStore(out_dir)
+    elif kind == 'json':
+        return JsonInfoStore(out_dir)
+    else:
+        raise ValueError('unknown store: {}'.format(kind))
+
+
+def copy_store(source, dest, batch_size=COPY_BATCH_SIZE):
+    'Copy all info objects from source store to dest store and return the number copied'
+    count = 0
+    batch = []
+    for info in source:
+        batch.append(info)
+        if len(batch) >= batch_size:
+            dest.save_many(batch)
+            count += len(batch)
+            batch = []
+    dest.save_many(batch)
+    return count + len(batch)
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='Convert info objects between JSON files and SQLite')
+    parser.add_argument('command', choices=('import', 'export'),
+        help='import: copy out_dir/info/*.json to out_dir/info.db;'
+            ' export: copy out_dir/info.db to out_dir/info/*.json')
+    parser.add_argument('out_dir', help='Output directory of project')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    json_store = JsonInfoStore(args.out_dir)
+    sqlite_store = SqliteInfoStore(args.out_dir)
+    if args.command == 'import':
+        count = copy_store(json_store, sqlite_store)
+    else:
+        count = copy_store(sqlite_store, json_store)
+    sqlite_store.close()
+    logger.info('Copied {} info objects'.format(count))
+
+
+if __name__ == '__main__':
+    main()
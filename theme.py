@@ -6,10 +6,26 @@ import logging
 
 import json
 import shutil
+import hashlib
 import jinja2
+import jinja2.meta
+
+import metrics
+from store import open_store
+from util import open_atomic
 
 DEFAULT_ORDER = '_sno'
+# Keys of info which are always available to the index templates (more can be given as fields)
+INDEX_FIELDS = ('id', 'title', '_sno', '_adj')
+INDEX_MANIFEST_FNAME = 'index_manifest.json'
+# Number of entries in each page of the index
+INDEX_PAGE_SIZE = 1000
+# Ids of all pages, loaded by _random.html when they aren't a range of numbers
+RANDOM_IDS_FNAME = '_ids.js'
+TEMPLATE_CACHE_DIRNAME = 'template_cache'
+RENDER_MANIFEST_FNAME = 'render_manifest.json'
 logger = logging.getLogger('theme')
+_environments = {}
 
 
 def copy(source, dest):
@@ -21,29 +37,129 @@ def copy(source, dest):
         shutil.copy(source_path, dest_path)
 
 
-def get_template(theme_dir, fname):
-    template_path = pjoin(theme_dir, 'templates', fname)
+def get_environment(theme_dir, cache_dir=None):
+    """Return the jinja2 Environment for templates in theme_dir/templates.
+
+    Environments are shared, so each template is compiled at most once per process.
+    If cache_dir is given, compiled templates are also cached there across processes.
+    """
+    key = (os.path.abspath(theme_dir), cache_dir)
+    env = _environments.get(key)
+    if env is None:
+        bytecode_cache = None
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            bytecode_cache = jinja2.FileSystemBytecodeCache(cache_dir)
+        env = jinja2.Environment(loader=jinja2.FileSystemLoader(pjoin(theme_dir, 'templates')),
+            bytecode_cache=bytecode_cache)
+        _environments[key] = env
+    return env
+
+
+def get_template(theme_dir, fname, cache_dir=None):
     try:
-        with open(template_path) as fobj:
-            return jinja2.Template(fobj.read())
-    except FileNotFoundError:
-        logger.error(template_path + ' was not found.')
+        return get_environment(theme_dir, cache_dir).get_template(fname)
+    except jinja2.TemplateNotFound:
+        logger.error(pjoin(theme_dir, 'templates', fname) + ' was not found.')
         return None
 
 
-def create_index(theme_dir, out_dir, order=DEFAULT_ORDER):
-    'Create index.html and other related files'
-    result = True
+def get_template_hash(theme_dir, fname, cache_dir=None):
+    'Return a hash of the source of a template and all templates it references'
+    env = get_environment(theme_dir, cache_dir)
+    sources = {}
+    pending = [fname]
+    while pending:
+        name = pending.pop()
+        if name in sources:
+            continue
+        sources[name] = env.loader.get_source(env, name)[0]
+        for ref in jinja2.meta.find_referenced_templates(env.parse(sources[name])):
+            # ref is None for templates whose names are computed at render time
+            if ref is not None:
+                pending.append(ref)
+    h = hashlib.sha1()
+    for name in sorted(sources):
+        h.update(name.encode())
+        h.update(b'\0')
+        h.update(sources[name].encode())
+        h.update(b'\0')
+    return h.hexdigest()
+
+
+def get_info_hash(info):
+    return hashlib.sha1(json.dumps(info, sort_keys=True).encode()).hexdigest()
+
+
+class RenderManifest:
+    """Records the hashes of the info and template each page was rendered from.
+
+    The manifest is stored at out_dir/render_manifest.json. A page needs to be rendered again
+    only if it is missing or if its info or template (including referenced templates) has changed.
+    """
+
+    def __init__(self, out_dir, template_hash):
+        self.path = pjoin(out_dir, RENDER_MANIFEST_FNAME)
+        self.template_hash = template_hash
+        try:
+            with open(self.path) as fobj:
+                self.entries = json.load(fobj)
+        except (FileNotFoundError, ValueError):
+            self.entries = {}
+        self.skipped = 0
+        self.rendered = 0
+        self.stale = 0
+
+    def get_entry(self, info):
+        return {'info': get_info_hash(info), 'template': self.template_hash}
 
-    info_dir = pjoin(out_dir, 'info')
-    info_list = []
-    for fname in os.listdir(info_dir):
-        if fname.endswith('.json'):
-            info_path = pjoin(info_dir, fname)
-            with open(info_path) as fobj:
-                info = json.load(fobj)
-            info_list.append(info)
+    def save(self):
+        with open_atomic(self.path) as fobj:
+            json.dump(self.entries, fobj)
 
+    def update(self, entries, skipped=0, rendered=0, stale=0):
+        'Merge the results of rendering pages elsewhere (like in another process)'
+        self.entries.update(entries)
+        self.skipped += skipped
+        self.rendered += rendered
+        self.stale += stale
+
+    def summary(self):
+        return 'Rendered {} pages ({} of them stale); skipped {} up-to-date pages'.format(
+            self.rendered, self.stale, self.skipped)
+
+
+def render_page(page_template, info, out_dir, force=False, manifest=None):
+    """Render info to out_dir/site and return whether a page was written.
+
+    Without a manifest, a page is rendered only if it doesn't exist.
+    With a manifest, a page is also rendered if its info or template has changed since it was last rendered.
+    """
+    outpath = pjoin(out_dir, 'site', info['id'] + '.html')
+    exists = os.path.isfile(outpath)
+    if manifest is not None:
+        entry = manifest.get_entry(info)
+        old_entry = manifest.entries.get(info['id'])
+        if exists and old_entry == entry and not force:
+            manifest.skipped += 1
+            return False
+        if exists and old_entry is not None and old_entry != entry:
+            manifest.stale += 1
+    elif exists and not force:
+        return False
+
+    with metrics.timer('render'):
+        output = page_template.render(info)
+        with open(outpath, 'w') as fobj:
+            fobj.write(output)
+    if manifest is not None:
+        manifest.entries[info['id']] = entry
+        manifest.rendered += 1
+    return True
+
+
+def find_sinks(info_list):
+    'Return lists of ids of comics which have no prev and no next respectively'
     id_set = {info['id'] for info in info_list}
 
     prev_sink_ids = []
@@ -55,6 +171,116 @@ def create_index(theme_dir, out_dir, order=DEFAULT_ORDER):
         next_id = info.get('_adj', {}).get('next')
         if next_id is None or next_id not in id_set:
             next_sink_ids.append(info['id'])
+    return (prev_sink_ids, next_sink_ids)
+
+
+def make_index_entry(info, order=DEFAULT_ORDER, fields=()):
+    'Return the part of info which is needed for creating the index'
+    entry = {k: info[k] for k in INDEX_FIELDS + tuple(fields) if k in info}
+    if order is not None:
+        entry[order] = info.get(order)
+    return entry
+
+
+def load_index_entries(out_dir, store=None, order=DEFAULT_ORDER, fields=None):
+    """Return index entries of all info objects, keyed by id.
+
+    Entries are cached in out_dir/index_manifest.json along with a stamp of the
+    info they were made from, so only info which has changed since the last call is read.
+    fields are keys of info which entries have besides INDEX_FIELDS;
+    if it is None, entries have the fields which the cached ones have.
+    """
+    if store is None:
+        store = open_store(out_dir)
+    manifest_path = pjoin(out_dir, INDEX_MANIFEST_FNAME)
+    try:
+        with open(manifest_path) as fobj:
+            manifest = json.load(fobj)
+    except (FileNotFoundError, ValueError):
+        manifest = None
+    if (manifest is None or manifest.get('store') != store.kind or manifest.get('order') != order
+            or (fields is not None and manifest.get('fields', []) != list(fields))):
+        manifest = {'store': store.kind, 'order': order, 'fields': list(fields or []), 'entries': {}}
+    fields = manifest.get('fields', [])
+    old_entries = manifest['entries']
+
+    entries = {}
+    updated = 0
+    for id, stamp in store.stamps().items():
+        entry = old_entries.get(id)
+        if entry is None or entry['_stamp'] != stamp:
+            info = store.load(id)
+            if info is None:
+                continue
+            entry = make_index_entry(info, order, fields)
+            entry['_stamp'] = stamp
+            updated += 1
+        entries[id] = entry
+    logger.debug('index manifest: {} entries, {} updated, {} removed'.format(
+        len(entries), updated, len(set(old_entries) - set(entries))))
+
+    if updated or len(entries) != len(old_entries):
+        manifest['entries'] = entries
+        with open_atomic(manifest_path) as fobj:
+            json.dump(manifest, fobj)
+    return entries
+
+
+def get_index_page_fname(number):
+    'Return the file name of the page of the index with the given number (starting from 1)'
+    return 'index.html' if number == 1 else 'index-{}.html'.format(number)
+
+
+def get_id_range(id_list):
+    """Return (start, stop) if id_list is the ids start, start + 1, ..., stop - 1 in some order, else None.
+
+    Such ids don't have to be listed for picking a random page.
+    """
+    if not id_list or not all(id.isdigit() and id == str(int(id)) for id in id_list):
+        return None
+    numbers = {int(id) for id in id_list}
+    start, stop = min(numbers), max(numbers) + 1
+    if len(numbers) != len(id_list) or stop - start != len(numbers):
+        return None
+    return (start, stop)
+
+
+def write_index_pages(template, out_dir, info_list, errors, page_size):
+    """Render info_list into pages of page_size entries each (or a single page if page_size is 0).
+
+    Pages left over from a bigger index are removed.
+    """
+    site_dir = pjoin(out_dir, 'site')
+    if not page_size:
+        page_size = max(len(info_list), 1)
+    count = max((len(info_list) + page_size - 1) // page_size, 1)
+    pages = [{'number': i, 'url': get_index_page_fname(i)} for i in range(1, count + 1)]
+    for i, page in enumerate(pages):
+        text = template.render(info_list=info_list[i * page_size: (i + 1) * page_size],
+            errors=errors, page=page, pages=pages, start=i * page_size,
+            prev_url=(pages[i - 1]['url'] if i > 0 else None),
+            next_url=(pages[i + 1]['url'] if i + 1 < count else None))
+        with open(pjoin(site_dir, page['url']), 'w') as fobj:
+            fobj.write(text)
+
+    number = count + 1
+    while os.path.isfile(pjoin(site_dir, get_index_page_fname(number))):
+        os.remove(pjoin(site_dir, get_index_page_fname(number)))
+        number += 1
+    return count
+
+
+def create_index(theme_dir, out_dir, order=DEFAULT_ORDER, store=None, page_size=INDEX_PAGE_SIZE, fields=()):
+    """Create index.html (split into pages of page_size entries) and other related files.
+
+    Only index entries (which are much smaller than info objects) are held in memory.
+    Entries have the keys in INDEX_FIELDS and fields.
+    """
+    result = True
+    cache_dir = pjoin(out_dir, TEMPLATE_CACHE_DIRNAME)
+
+    info_list = list(load_index_entries(out_dir, store, order, fields).values())
+    prev_sink_ids, next_sink_ids = find_sinks(info_list)
 
     errors = []
     if len(prev_sink_ids) == 0:
@@ -74,15 +300,14 @@ def create_index(theme_dir, out_dir, order=DEFAULT_ORDER):
 
     os.makedirs(pjoin(out_dir, 'site'), exist_ok=True)
 
-    index_template = get_template(theme_dir, 'index.html')
+    index_template = get_template(theme_dir, 'index.html', cache_dir)
     if index_template is None:
         result = False
     else:
-        page = index_template.render(info_list=info_list, errors=errors)
-        with open(pjoin(out_dir, 'site', 'index.html'), 'w') as fobj:
-            fobj.write(page)
+        count = write_index_pages(index_template, out_dir, info_list, errors, page_size)
+        logger.debug('index: {} entries in {} pages'.format(len(info_list), count))
 
-    redirect_template = get_template(theme_dir, 'redirect.html')
+    redirect_template = get_template(theme_dir, 'redirect.html', cache_dir)
     if redirect_template is None:
         result = False
     else:
@@ -93,12 +318,22 @@ def create_index(theme_dir, out_dir, order=DEFAULT_ORDER):
         with open(pjoin(out_dir, 'site', '_last.html'), 'w') as fobj:
             fobj.write(page)
 
-    random_template = get_template(theme_dir, 'random.html')
+    random_template = get_template(theme_dir, 'random.html', cache_dir)
     if random_template is None:
         result = False
     else:
         id_list = [info['id'] for info in info_list]
-        page = random_template.render(id_list=json.dumps(id_list))
+        id_range = get_id_range(id_list)
+        ids_path = pjoin(out_dir, 'site', RANDOM_IDS_FNAME)
+        if id_range is None:
+            # A script rather than JSON, since browsers don't let pages opened from disk fetch files.
+            with open(ids_path, 'w') as fobj:
+                fobj.write('var ids = {};\n'.format(json.dumps(id_list, separators=(',', ':'))))
+        elif os.path.isfile(ids_path):
+            os.remove(ids_path)
+        # id_list is still passed for themes whose random.html embeds the ids.
+        page = random_template.render(id_list=id_list, id_range=id_range,
+            ids_url=(RANDOM_IDS_FNAME if id_range is None and id_list else None))
         with open(pjoin(out_dir, 'site', '_random.html'), 'w') as fobj:
             fobj.write(page)
 
@@ -111,10 +346,15 @@ def main():
     parser.add_argument('out_dir')
     parser.add_argument('theme')
     parser.add_argument('--order', default=DEFAULT_ORDER)
+    parser.add_argument('--page-size', type=int, default=INDEX_PAGE_SIZE,
+        help='number of entries in each page of the index (0 for a single page)')
+    parser.add_argument('--fields', nargs='+', default=[], metavar='KEY',
+        help='more keys of info which are available to the index template')
     args = parser.parse_args()
 
     copy(pjoin(args.theme, 'static'), pjoin(args.out_dir, 'site'))
-    found_index = create_index(args.theme, args.out_dir, order=args.order)
+    found_index = create_index(args.theme, args.out_dir, order=args.order, page_size=args.page_size,
+        fields=args.fields)
     if found_index:
         logger.info('created index')
 
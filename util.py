@@ -0,0 +1,63 @@
+"""
+Helpers shared by several modules: atomic file writes, append-only JSON logs
+and process pools which work on chunks of ids.
+"""
+
+import os
+import json
+from itertools import repeat
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+
+# state of a worker process of map_chunks, set by its initializer
+worker_state = {}
+
+
+@contextmanager
+def open_atomic(path, mode='w', fsync=False):
+    """Open a temporary file which replaces path when it is closed,
+    so that readers (and a crash while writing) never leave a partly written file at path.
+
+    If fsync is True, the file is synced to disk before it replaces path.
+    """
+    tmp_path = path + '.tmp'
+    with open(tmp_path, mode) as fobj:
+        yield fobj
+        if fsync:
+            fobj.flush()
+            os.fsync(fobj.fileno())
+    os.replace(tmp_path, path)
+
+
+def write_atomic(path, text):
+    'Write text to path such that readers never see a partly written file'
+    with open_atomic(path) as fobj:
+        fobj.write(text)
+
+
+def read_json_lines(path):
+    'Yield the JSON records of an append-only log with a record on each line, which need not exist'
+    try:
+        with open(path) as fobj:
+            for line in fobj:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    # A crash while appending can leave a partial record at the end.
+                    return
+    except FileNotFoundError:
+        pass
+
+
+def chunks(l, size):
+    for i in range(0, len(l), size):
+        yield l[i: i + size]
+
+
+def map_chunks(fn, items, chunk_size, workers, initializer, initargs, *args):
+    """Call fn(chunk, *args) on chunks of chunk_size items in a pool of processes and yield the results in order.
+
+    initializer(*initargs) is called in each process first; it can keep state in worker_state.
+    """
+    with ProcessPoolExecutor(workers, initializer=initializer, initargs=initargs) as executor:
+        yield from executor.map(fn, chunks(items, chunk_size), *(repeat(arg) for arg in args))